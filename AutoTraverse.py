@@ -1,11 +1,55 @@
-import requests
 import os
+import sys
 import argparse
 import textwrap
-import yaml
+import importlib
 import json
 import hashlib
-from bs4 import BeautifulSoup
+import threading
+import time
+import heapq
+import email.utils
+import re
+import fnmatch
+import io
+import html
+import calendar
+from datetime import datetime
+import multiprocessing
+import errno
+import http.client
+import contextlib
+import atexit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit, unquote
+
+class LazyModule(object):
+  """Stands in for a module until something in it is first used, so importing AutoTraverse stays quick."""
+  def __init__(self, name: str, *args, **kwargs):
+    self._name = name
+    self._module = None
+
+  def __getattr__(self, attr: str):
+    if self._module is None:
+      self._module = importlib.import_module(self._name)
+    return getattr(self._module, attr)
+
+requests = LazyModule("requests")
+urllib3 = LazyModule("urllib3")
+# Only ever imported if asked for, to respect people's right to not run code from Google
+progressbar = LazyModule("progressbar")
+
+def parse_age(text: str) -> int:
+  """Seconds since the epoch for a date (YYYY-MM-DD, optionally with HH:MM) or an age back from now (e.g. 12h, 7d, 4w)."""
+  age = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([smhdw])", text.strip())
+  if age:
+    return int(time.time() - float(age[1]) * {"s" : 1, "m" : 60, "h" : 3600, "d" : 86400, "w" : 604800}[age[2]])
+  for date_format in ["%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S"]:
+    try:
+      return calendar.timegm(datetime.strptime(text.strip(), date_format).timetuple())
+    except ValueError:
+      pass
+  raise ValueError(f"Not a date or age: {text}")
 
 # Default config with help and stuff
 # Adding an entry here will add it to:
@@ -34,7 +78,7 @@ default_config = {
     int, False, False
   ],
   "chunksize" : [
-    "Chunk size for writing to disk (default is 4096).",
+    "Smallest block size for reading and writing downloads (default is 4096). Blocks grow from there with file size and link speed.",
     "Specify a custom chunk size",
     int, 4096, False
   ],
@@ -58,6 +102,21 @@ default_config = {
     "Do you want to ignore directory structure when expanding archives?",
     bool, False, False
   ],
+  "--extract-workers" : [
+    "Number of archives to expand at the same time, in separate processes (default is 2).",
+    "How many archives should be expanded at the same time (default is 2)?",
+    int, 2, False
+  ],
+  "--zip-workers" : [
+    "Number of threads expanding the members of each ZIP archive (default is 4).",
+    "How many threads should expand the members of each ZIP archive (default is 4)?",
+    int, 4, False
+  ],
+  "--stream-expand" : [
+    "Expand compressed files and tar archives as they download instead of saving them first (requires --expand).",
+    "Do you want to expand compressed files and tar archives as they download instead of saving them first?",
+    bool, False, False
+  ],
   "--skip-cert-check" : [
     "Skip certificate checks when making HTTPS connections.",
     "Do you want to skip certificate validation when making HTTPS connections?",
@@ -83,166 +142,186 @@ default_config = {
     "Do you want fancy progress bars?",
     bool, False, False
   ],
+  "--workers" : [
+    "Number of files to download at the same time (default is 1).",
+    "How many files should be downloaded at the same time (default is 1)?",
+    int, 1, False
+  ],
+  "--host-connections" : [
+    "Maximum number of simultaneous downloads from a single host (default is 4).",
+    "How many simultaneous downloads should be allowed per host (default is 4)?",
+    int, 4, False
+  ],
+  "--pool-size" : [
+    "Number of connections to keep open for reuse per host (default is 10).",
+    "How many connections should be kept open for reuse per host (default is 10)?",
+    int, 10, False
+  ],
+  "--retries" : [
+    "Number of times to retry failed connections and server errors, and to requeue failed files (default is 3).",
+    "How many times should failed requests be retried (default is 3)?",
+    int, 3, False
+  ],
+  "--rate-limit" : [
+    "Maximum total download speed in bytes per second (default is 0 for unlimited).",
+    "What should total download speed be capped at, in bytes per second (blank for unlimited)?",
+    int, 0, False
+  ],
+  "--host-rate-limit" : [
+    "Maximum download speed from a single host in bytes per second (default is 0 for unlimited).",
+    "What should download speed from a single host be capped at, in bytes per second (blank for unlimited)?",
+    int, 0, False
+  ],
+  "--list-workers" : [
+    "Number of directories to list at the same time (default is 4).",
+    "How many directories should be listed at the same time (default is 4)?",
+    int, 4, False
+  ],
+  "--sample-peek" : [
+    "Determine uniqueness by hashing samples from the start, middle and end of files using Range requests.",
+    "Do you want to check files for changes by sampling them throughout instead of reading their start?",
+    bool, False, False
+  ],
+  "--content-hash" : [
+    "Hash algorithm for whole-file content hashes, e.g. blake2b or sha256 (default is none).",
+    "Which hash algorithm should be used to hash whole files, e.g. blake2b or sha256 (blank for none)?",
+    str, "", False
+  ],
+  "--link-duplicates" : [
+    "Hardlink files whose content matches a file already mirrored instead of storing them again.",
+    "Do you want identical files to be hardlinked to each other instead of stored twice?",
+    bool, False, False
+  ],
+  "--listing-parser" : [
+    "Directory listing parser to use: auto, fast or bs4 (default is auto).",
+    "Which directory listing parser should be used: auto, fast or bs4 (default is auto)?",
+    str, "auto", False
+  ],
+  "--skip-unchanged-dirs" : [
+    "Skip directories whose listing hasn't changed since the last run, along with everything under them.",
+    "Do you want to skip directories whose listing hasn't changed since the last run (changes further down can be missed)?",
+    bool, False, False
+  ],
+  "-include" : [
+    "Only download files matching one of these patterns. Globs without a / match file names at any depth, globs with one match the path from the top (** for any number of directories). Prefix a pattern with re: for a regex.",
+    "Which files should be downloaded, as space separated patterns (blank for all of them)?",
+    list, [], False
+  ],
+  "-exclude" : [
+    "Skip files matching any of these patterns (same syntax as -include).",
+    "Which files should be skipped, as space separated patterns (blank for none)?",
+    list, [], False
+  ],
+  "-include-dirs" : [
+    "Only download files from directories matching one of these patterns, or below them (same syntax as -include). Directories that can't lead to a match aren't listed at all.",
+    "Which directories should files be downloaded from, as space separated patterns (blank for all of them)?",
+    list, [], False
+  ],
+  "-exclude-dirs" : [
+    "Skip directories matching any of these patterns, and everything below them, without listing them (same syntax as -include).",
+    "Which directories should be skipped, as space separated patterns (blank for none)?",
+    list, [], False
+  ],
+  "--min-size" : [
+    "Skip files smaller than this many bytes (default is 0 for no minimum).",
+    "What's the smallest file, in bytes, that should be downloaded (blank for no minimum)?",
+    int, 0, False
+  ],
+  "--max-size" : [
+    "Skip files larger than this many bytes (default is 0 for no maximum).",
+    "What's the largest file, in bytes, that should be downloaded (blank for no maximum)?",
+    int, 0, False
+  ],
+  "--newer-than" : [
+    "Skip files last modified before this date (YYYY-MM-DD) or age (e.g. 12h, 7d, 4w).",
+    "How new does a file need to be to get downloaded, as a date (YYYY-MM-DD) or age (e.g. 7d) (blank for any age)?",
+    str, "", False
+  ],
+  "--plan-only" : [
+    "Only walk the tree and write the files that need downloading (with their size and why) to this file.",
+    "Should the tree only be walked, writing a download plan to a file (blank to download as usual)?",
+    str, "", False
+  ],
+  "--plan" : [
+    "Download the files in this plan (from --plan-only) instead of walking the tree.",
+    "Which download plan should be run (blank to walk the tree as usual)?",
+    str, "", False
+  ],
+  "--shard" : [
+    "Only download this process's share of the files, given as i/N (e.g. 2/4), so several processes or machines can split a mirror.",
+    "Which share of the files should this process download, as i/N (blank for all of them)?",
+    str, "", False
+  ],
+  "--sync-interval" : [
+    "Most seconds of manifest updates that can be lost in a crash. Updates are written and synced to disk in batches this often (default is 1, 0 syncs every update).",
+    "How often, in seconds, should manifest updates be synced to disk (default is 1)?",
+    float, 1.0, False
+  ],
+  "--report" : [
+    "Write a JSON run report (counters and per-phase timings, overall and per host) to this file when done.",
+    "Where should the run report be written (blank for nowhere)?",
+    str, "", False
+  ],
+  "--prometheus-file" : [
+    "Write the run's metrics to this file in Prometheus textfile format when done.",
+    "Where should Prometheus metrics be written (blank for nowhere)?",
+    str, "", False
+  ],
 }
 
-# Populate argument parser
-parser = argparse.ArgumentParser(
-  prog="AutoTraverse",
-  formatter_class=argparse.RawDescriptionHelpFormatter,
-  description=textwrap.dedent("""\
-    AutoTraverse v0.4.2a
-      by Caleb White
-       
-    Simple tool to traverse web directories and download all files contained in them.
-    
-    Options to auto-expand archives and compressed files."""),
-  epilog="""\
-Note: If you do not specify a protocol, https:// will be prepended to your URL.
-  
-Download all the things!"""
-)
-
-for option in default_config.keys():
-  if option[:2] == "--":
-    parser.add_argument(
-      option,
-      help=default_config[option][0],
-      required=default_config[option][4],
-      action="store_true",
-      dest=option[2:]
-    )
-  elif option[:1] == "-":
-    parser.add_argument(
-      option,
-      help=default_config[option][0],
-      required=default_config[option][4],
-      type=default_config[option][2],
-      nargs="+",
-      dest=option[1:]
-    )
-  else:
-    parser.add_argument(
-      option,
-      help=default_config[option][0],
-      type=default_config[option][2],
-      nargs="?"
-    )
-
-parser.add_argument(
-  "--moo",
-  help=argparse.SUPPRESS,
-  required=False,
-  action='store_true',
-  dest="moo")
-
-args = parser.parse_args()
-
-# Moo - the most important part of all this nonsense
-if args.moo:
-  print(textwrap.dedent("""\
-           ,=    ,        =.
-  _  _   /'/    )\\,/,/(_   \\`\\
-   `//-.|  (  ,\\\\)\\//\\)\\/_  ) |
-   //___\\   `\\\\\\/\\\\/\\/\\\\///'  /
-,-\"~`-._ `\"--'_   `\"\"\"`  _ \\`'\"~-,_
-\\       `-.  '_`.      .'_` \\ ,-\"~`/
- `.__.-'`/   (-\\        /-) |-.__,'
-   ||   |     \\O)  /^\\ (O/  |
-   `\\\\  |         /   `\\    /
-the  \\\\  \\       /      `\\ /
-cow   `\\\\ `-.  /' .---.--.\\
-says    `\\\\/`~(, '()      ()
-'moo'    /(O) \\\\   _,.-.,_)
-        //  \\\\ `\\'`      /
-       / |  ||   `\"\"~~~\"`
-     /'  |__||
-           `o """))
-  exit(0)
-
-# Load settings or use defaults
-config = {}
-if os.path.isfile("settings.yml"):
-  config = yaml.safe_load(open("settings.yml"))
-if not config:
-  config = default_config.copy()
-
-# Override default/stored values with commandline input
-for option in default_config.keys():
-  # Strip "--" and "-" from input names to make suitable variable names
-  option_name = option[2:] if option[:2] == "--" else option
-  option_name = option_name[1:] if option_name[:1] == "-" else option_name
-  if getattr(args, option_name):
-    if not type(getattr(args, option_name)) is default_config[option][2]:
-      config[option_name] = default_config[option][2](getattr(args, option_name))
-    else:
-      config[option_name] = getattr(args, option_name)
-
-# If config is default, offer first time wizard
-if config == default_config:
-  print("Welcome to AutoTraverse!")
-  response = input("Would you like to go through initial configuration? [Y]es/[n]o ")
-  if response == "" or response[0] in ["y", "Y"]:
-    for option in default_config.keys():
-      option_name = option[2:] if option[:2] == "--" else option
-      option_name = option_name[1:] if option_name[:1] == "-" else option_name
-      option_value = None
-      while type(option_value) is not default_config[option][2]:
-        if default_config[option][2] == bool:
-          option_value = input(f"{default_config[option][1]} {'[Y]/[n]' if default_config[option][3] else '[y]/[N]'}: ")
-          if option_value == "":
-            option_value = default_config[option][3]
-          else:
-            option_value = True if option_value[0] in ["y", "Y"] else False
-        else:
-          option_value = input(f"{default_config[option][1]}{' (blank to skip)' if not default_config[option][4] else ''}: ")
-          if option_value == "" and not default_config[option][4]:
-            break
-        if option_value == "" and default_config[option][4]:
-          print("This option is required. Please try again.")
-          option_value = None
-      if option_value:
-        config[option_name] = option_value
-
-# Handle defaults that weren't overwritten
-for option in default_config.keys():
-  option_name = option[2:] if option[:2] == "--" else option
-  option_name = option_name[1:] if option_name[:1] == "-" else option_name
-  if option_name not in config.keys() or config[option_name] == default_config[option]:
-    config[option_name] = default_config[option][3]
-
-# Scrub leftover defaults
-for option in [x for x in config.keys()]:
-  if option[0] == "-":
-    del config[option]
-
-# Final checks and input normalizing
-if not config["url"] or not config["path"]:
-  print("You must specify a URL and a path.",
-    f"Run python {os.path.basename(__file__)} -h for details.")
-  exit(1)
-if not config["url"][-1] == "/":
-  config["url"] = f"{config['url']}/"
-if "http://" not in config["url"] and "https://" not in config["url"]:
-  config["url"] = f"https://{config['url']}"
-if not os.path.isdir(config["path"]):
-  try:
-    os.makedirs(config["path"])
-  except:
-    print(f"Path does not exist and failed to create it: {config['path']}")
-    exit(1)
+def defaults() -> dict:
+  """Every option's default value, keyed the way a config is."""
+  return {option.lstrip("-") : list(value[3]) if isinstance(value[3], list) else value[3] for option, value in default_config.items()}
 
-# Write config if requested
-if config["write-config"]:
-  with open("settings.yml", "w") as f:
-    yaml.safe_dump(config, f)
+def check_config(config: dict) -> dict:
+  """
+    Checks and normalizes a config, filling in defaults for anything it leaves out.
 
-if config["progressbar"]:
-  # This is only imported on demand to respect people's right to not run code from Google
-  import progressbar
+    Returns the normalized copy. Raises ValueError if the config can't work.
+  """
+  config = dict(defaults(), **config)
+  if not config["url"] or not config["path"]:
+    raise ValueError("You must specify a URL and a path.")
+  if config["listing-parser"] not in ["auto", "fast", "bs4"]:
+    raise ValueError(f"Unknown listing parser: {config['listing-parser']}. Choose auto, fast or bs4.")
+  if config["link-duplicates"] and not config["content-hash"]:
+    config["content-hash"] = "blake2b"
+  if config["content-hash"] and config["content-hash"] not in hashlib.algorithms_available:
+    raise ValueError(f"Unknown hash algorithm: {config['content-hash']}")
+  if config["shard"] and not re.fullmatch(r"[1-9][0-9]*/[1-9][0-9]*", config["shard"]) \
+      or config["shard"] and int(config["shard"].split("/")[0]) > int(config["shard"].split("/")[1]):
+    raise ValueError(f"Bad shard: {config['shard']}. Give it as i/N, with i from 1 to N.")
+  for option in ["include", "exclude", "include-dirs", "exclude-dirs"]:
+    # A single pattern is easy to write as a plain string in settings.yml
+    if isinstance(config[option], str):
+      config[option] = [config[option]]
+  if config["newer-than"]:
+    try:
+      parse_age(config["newer-than"])
+    except ValueError:
+      raise ValueError(f"Can't make sense of --newer-than {config['newer-than']}. Give a date (YYYY-MM-DD) or an age (e.g. 7d).")
+  if config["plan"] and config["plan-only"]:
+    raise ValueError("Use --plan-only to write a plan and --plan to run one, not both at once.")
+  if not config["url"][-1] == "/":
+    config["url"] = f"{config['url']}/"
+  if "http://" not in config["url"] and "https://" not in config["url"]:
+    config["url"] = f"https://{config['url']}"
+  if not os.path.isdir(config["path"]):
+    try:
+      os.makedirs(config["path"])
+    except:
+      raise ValueError(f"Path does not exist and failed to create it: {config['path']}")
+  return config
 
 # Build Traverse class
 class Traverse(object):
+  """
+    One mirror job. Takes a config like settings.yml holds, with defaults filled in for anything left out.
+
+    Traverse({"url" : "https://example.com/files/", "path" : "mirror"}).run()
+  """
   def __init__(self, config: dict, *args, **kwargs):
+    config = check_config(config)
     self.base_depth = config["url"].count("/") -3
     config["depth"] += self.base_depth
     self.config = config
@@ -254,52 +333,219 @@ class Traverse(object):
     if config["expand"] and not config["flat"]:
       print("WARNING! Archives will be expanded automatically. This combination of options should only be used with trusted sources!")
 
+    if config["progressbar"] and config["workers"] > 1:
+      print("Progress bars are not available with concurrent downloads. Disabling them.")
+      config["progressbar"] = False
+
     self.manifest_file = os.path.join(config["path"], ".manifest")
-    self.manifest = [DownloadFile()]
+    # Shards download into the same tree, so each keeps a journal of its own to be merged later
+    self.shard = tuple(int(x) for x in config["shard"].split("/")) if config["shard"] else None
+    journal_file = f"{self.manifest_file}.shard-{self.shard[0]}-of-{self.shard[1]}" if self.shard else None
+    self.plan_file = None
+    self.plan_lock = threading.Lock()
+
+    # Pruning rules, checked before anything gets listed or requested
+    self.include = PathFilter(config["include"])
+    self.exclude = PathFilter(config["exclude"])
+    self.include_dirs = PathFilter(config["include-dirs"])
+    self.exclude_dirs = PathFilter(config["exclude-dirs"])
+    self.newer_than = parse_age(config["newer-than"]) if config["newer-than"] else 0
+    self.manifest_lock = threading.Lock()
     self.cur_depth = 0
 
+    # Downloads are handed to a worker pool so directory listing never waits on them
+    self.pool = ThreadPoolExecutor(max_workers=max(1, config["workers"]))
+    self.pending = []
+    self.pending_lock = threading.Lock()
+    # Set when the run is cut short, so downloads in progress save what they have and stop
+    self.stopping = threading.Event()
+
+    # Archives are expanded in other processes so downloads keep going meanwhile
+    self.extracting = []
+    self.extract_slots = threading.BoundedSemaphore(2 * max(1, config["extract-workers"]))
+    self.extractors_lock = threading.Lock()
+    self.extractors = self.new_extractors() if config["expand"] else None
+    self.host_slots = {}
+    self.host_slots_lock = threading.Lock()
+    self.bandwidth = TokenBucket(config["rate-limit"])
+    # Downloads that failed for now, as (when to try again, attempts so far, get_leaf arguments...)
+    self.retry_queue = []
+    # Each download worker's read buffer
+    self.buffers = threading.local()
+
     if config["skip-cert-check"]:
       requests.packages.urllib3.disable_warnings()
 
+    # One session for everything so connections (and TLS handshakes) get reused
+    self.session = self.new_session()
+
+    # Subscribe to self.metrics to follow along as the run goes
+    self.metrics = Metrics()
+
+    with self.metrics.timed("manifest-load"):
+      self.manifest = Manifest(self.manifest_file, config["sync-interval"], journal_file)
+    self.listings = ListingCache(os.path.join(config["path"], ".listings"))
+    self.on_file = None
+
+  def run(self, on_file = None) -> 'RunResult':
+    """
+      Runs the job: the plan if one was given, otherwise a walk of the tree. Cleans up after itself either way.
+
+      on_file, if given, is called as on_file(event, F) with each file that's downloaded, skipped, filtered or failed.
+    """
+    self.on_file = on_file
     try:
-      with open(self.manifest_file, "r") as f:
-        self.manifest = str(f.readlines()[0]) or "[]"
-        try:
-          if self.manifest:
-            # Some very basic attempts to clean the manifest
-            while self.manifest[-1:] in ["\n", ","]:
-              self.manifest = self.manifest[:-1]
-            if self.manifest[0] != "[":
-              self.manifest = f"[{self.manifest}]"
-            #print(self.manifest)
-            self.manifest = [DownloadFile(x) for x in json.loads(self.manifest)]
-        except:
-          print(f"Corrupted manifest: {self.manifest_file}")
-          os.rename(self.manifest_file, f"{self.manifest_file}.corrupted")
-          os._exit(1)
-    except:
-      f = open(self.manifest_file, "w")
-      f.close()
-    
+      ok = self.execute(self.config["plan"]) if self.config["plan"] else self.traverse()
+    except BaseException:
+      self.stop()
+      raise
+    finally:
+      self.close()
+    report = self.metrics.report()
+    # Files or directories that never made it leave holes in the mirror, even if the walk itself went fine
+    return RunResult(ok and not report["summary"]["errors"], report)
+
+  def stop(self) -> None:
+    """Cuts the run short (e.g. on Ctrl-C). Queued downloads are dropped, and ones in progress record how far they got."""
+    self.stopping.set()
+    self.pool.shutdown(wait=False, cancel_futures=True)
+    if self.extractors:
+      self.extractors.shutdown(wait=False, cancel_futures=True)
+
+  def close(self) -> None:
+    """Lets go of worker pools, connections and the manifest, so a long-lived process can run job after job."""
+    self.pool.shutdown()
+    if self.extractors:
+      self.extractors.shutdown()
+    self.session.close()
+    if not self.manifest.closed.is_set():
+      self.manifest.close()
+
+  def file_event(self, event: str, F: 'DownloadFile') -> None:
+    if self.on_file:
+      self.on_file(event, F)
 
   def traverse(self, branch: str = "") -> bool:
-    if branch == "":
-      print(f"Loading {self.config['url']}")
-    page = requests.get(
-      f"{self.config['url']}{branch}",
-      headers=self.headers,
-      verify=not self.config["skip-cert-check"]
-    )
-    if not page.ok:
-      print(f"Bad response ({page.status_code}) getting directory {branch}")
+    """Walks the tree breadth-first, listing several directories at once and queueing leaves as they turn up."""
+    print(f"Loading {self.config['url']}{branch}")
+    if self.config["plan-only"]:
+      self.plan_file = open(self.config["plan-only"], "w")
+      self.plan_file.write(f"{json.dumps({'url' : self.config['url'], 'path' : self.config['path']})}\n")
+    ok = True
+    with ThreadPoolExecutor(max_workers=max(1, self.config["list-workers"])) as lister:
+      listing = {lister.submit(self.read_branch, branch): (branch, 0)}
+      # Listings that failed for now, as (when to try again, attempts so far, branch)
+      delayed = []
+      try:
+        while listing or delayed:
+          while delayed and delayed[0][0] <= time.time():
+            _, attempt, node = heapq.heappop(delayed)
+            listing[lister.submit(self.read_branch, node)] = (node, attempt)
+          timeout = max(0, delayed[0][0] - time.time()) if delayed else None
+          if not listing:
+            time.sleep(timeout)
+            continue
+          done, _ = wait(listing, timeout=timeout, return_when=FIRST_COMPLETED)
+          for future in done:
+            node, attempt = listing.pop(future)
+            try:
+              frontier = future.result()
+            except (RetryLater, requests.RequestException) as e:
+              if attempt < self.config["retries"]:
+                self.metrics.count("retries", phase="listing")
+                delay = self.retry_delay(e, attempt)
+                print(f"Failed to read directory {node}: {e} Trying again in {delay:.0f}s.")
+                heapq.heappush(delayed, (time.time() + delay, attempt + 1, node))
+                continue
+              print(f"Failed to read directory {node}: {e} Giving up.")
+              frontier = None
+            except Exception as e:
+              print(f"Failed to read directory {node}: {e}")
+              frontier = None
+            if frontier is None:
+              self.metrics.count("errors", phase="listing")
+              ok = ok and node != branch
+              continue
+            for node in frontier:
+              listing[lister.submit(self.read_branch, node)] = (node, 0)
+      except BaseException:
+        # Don't sit out the listings still queued when we're cut short
+        self.stop()
+        lister.shutdown(wait=False, cancel_futures=True)
+        raise
+
+    self.finish_leaves()
+    self.manifest.close()
+    # Plans and shards don't fetch every file they list, so saving their listings would let
+    # --skip-unchanged-dirs skip the rest. Shards running side by side would also race on the file.
+    if not self.plan_file and not self.shard:
+      with self.metrics.timed("listing-cache-save"):
+        self.listings.save()
+    if self.plan_file:
+      self.plan_file.close()
+      print(f"Planned {self.metrics.total('files-planned'):.0f} files ({self.metrics.total('bytes-planned'):.0f} bytes known) in {self.config['plan-only']}")
+    self.write_reports()
+    if not ok:
       return False
+    print("Done!")
+    return True
+
+  def execute(self, plan_file: str) -> bool:
+    """Downloads the files in a plan written by --plan-only, or this process's shard of them."""
+    print(f"Running plan {plan_file}")
+    with open(plan_file, "r") as f:
+      header = json.loads(f.readline())
+      if header["url"] != self.config["url"]:
+        print(f"This plan is for {header['url']}, not {self.config['url']}")
+        return False
+      for line in f:
+        step = json.loads(line)
+        listed = ListingEntry(step["leaf"], step["leaf"], step["mtime"], step["size"], step["size_slack"])
+        # Things may have moved on since the plan was made, e.g. an earlier run of it got this file
+        needed, manfile, changed = self.check_leaf(step["branch"], step["leaf"], listed)
+        if needed:
+          self.queue_leaf(step["branch"], step["leaf"], manfile, listed, changed)
+    self.finish_leaves()
+    self.manifest.close()
+    self.write_reports()
+    print("Done!")
+    return True
+
+  def write_reports(self) -> None:
+    """Writes the run report and Prometheus metrics, if asked for."""
+    self.metrics.observe("manifest-write", self.manifest.write_seconds)
+    self.metrics.set("manifest-records", len(self.manifest))
+    if self.config["report"]:
+      with open(self.config["report"], "w") as f:
+        json.dump(self.metrics.report(), f, indent=2)
+    if self.config["prometheus-file"]:
+      # Written aside and moved into place so a collector never reads half a file
+      with open(f"{self.config['prometheus-file']}.tmp", "w") as f:
+        f.write(self.metrics.prometheus())
+      os.replace(f"{self.config['prometheus-file']}.tmp", self.config["prometheus-file"])
+
+  def skipped(self, F: 'DownloadFile', reason: str) -> None:
+    """Counts a file that didn't need downloading."""
+    host = urlsplit(F.source).netloc
+    self.metrics.count("files-skipped", reason=reason, host=host)
+    self.metrics.count("bytes-skipped", F.dsize, host=host)
+    self.file_event("skipped", F)
+
+  def read_branch(self, branch: str) -> list:
+    """Lists one directory, queues its leaves for download and returns the subdirectories to visit next."""
+    if self.stopping.is_set():
+      return []
+    with self.host_slot(f"{self.config['url']}{branch}"):
+      entries, unchanged = self.get_listing(branch)
+    if entries is None:
+      return None
+    if unchanged and self.config["skip-unchanged-dirs"]:
+      print(f"Directory {branch or '/'} is unchanged. Skipping it.")
+      return []
     
-    seen_files = [x.name for x in self.manifest if x.path == os.path.join(self.config['path'], branch)]
-    
-    tree = BeautifulSoup(page.text, "html.parser")
-    
-    for node in tree.find_all("a"):
-      node_href = node.get("href")
+    frontier = []
+    for entry in entries:
+      node_href = entry.href
       if node_href[0:4] == "http":
         if not self.config["url"] in node_href:
           print(f"Ignoring off-site link: {node_href}")
@@ -316,38 +562,352 @@ class Traverse(object):
         if self.config["depth"] not in [False, -1]:
           if node.count("/") > self.config["depth"]:
             continue
+        if not self.wanted_dir(node):
+          self.metrics.count("dirs-pruned")
+          continue
         print(f"{'Going deeper! ' if node.count('/') > self.cur_depth else ''}Reading {node}")
-        self.cur_depth = node.count("/")
-        self.traverse(node)
+        self.cur_depth = max(self.cur_depth, node.count("/"))
+        frontier.append(node)
         continue
       # Make sure we're only following links to leaves at current depth
-      if not (node_href == f"{branch}{node.contents[0]}" or node_href == node.contents[0]):
+      if not (node_href == f"{branch}{entry.text}" or node_href == entry.text):
         continue
-      manfile = None
-      if node_href in seen_files:
-        if self.config["assume-unchanged"]:
-          continue
-        manfile = [x for x in self.manifest if x.source == f"{self.config['url']}{branch}{node_href}"][0]
-      self.get_leaf(branch, node_href, manfile)
-    
-    if branch == "":
-      f = open(self.manifest_file, "w")
-      f.close()
-      with open(self.manifest_file, "a") as f:
-        for manfile in self.manifest:
-          f.write(f"{json.dumps(manfile.__dict__)},")
-      print("Done!")
+      if not self.wanted_file(branch, node_href, entry):
+        self.metrics.count("files-filtered")
+        continue
+      needed, manfile, changed = self.check_leaf(branch, node_href, entry)
+      if needed:
+        self.queue_leaf(branch, node_href, manfile, entry, changed)
+    return frontier
+
+  def wanted_dir(self, node: str) -> bool:
+    """Whether a directory is worth listing under the include and exclude rules."""
+    path = unquote(node).strip("/")
+    if self.exclude_dirs.matches_within(path):
+      return False
+    if self.include_dirs and not (self.include_dirs.matches_within(path) or self.include_dirs.may_lead_to(path)):
+      return False
+    # File patterns that name directories can rule out whole subtrees too
+    return self.include.may_lead_to(path) if self.include else True
+
+  def wanted_file(self, branch: str, leaf: str, entry: 'ListingEntry' = None) -> bool:
+    """Whether a file passes the include, exclude, size and date rules, as far as the listing can tell."""
+    if self.include_dirs and not self.include_dirs.matches_within(unquote(branch).strip("/")):
+      return False
+    path = unquote(f"{branch}{leaf}")
+    if self.include and not self.include.matches(path):
+      return False
+    if self.exclude.matches(path):
+      return False
+    if entry and entry.size is not None and not self.wanted_size(entry.size, entry.size_slack):
+      return False
+    if entry and entry.mtime and not self.wanted_date(entry.mtime):
+      return False
+    return True
+
+  def wanted_size(self, size: int, slack: int = 0) -> bool:
+    """Whether a size is within --min-size and --max-size, giving it the benefit of any doubt."""
+    if self.config["min-size"] and size + slack < self.config["min-size"]:
+      return False
+    if self.config["max-size"] and size - slack > self.config["max-size"]:
+      return False
+    return True
+
+  def wanted_date(self, mtime: int) -> bool:
+    """Whether a modification time is recent enough for --newer-than."""
+    return mtime >= self.newer_than
+
+  def check_leaf(self, branch: str, leaf: str, entry: 'ListingEntry') -> (bool, 'DownloadFile', bool):
+    """
+      Decides from the manifest and the listing whether a leaf might need downloading.
+
+      Returns whether it does, its manifest record if there is one, and whether it's known to have changed.
+    """
+    manfile = self.manifest.get(f"{self.config['url']}{branch}{leaf}")
+    if manfile is None:
+      self.metrics.count("manifest-misses")
+      return True, None, False
+    self.metrics.count("manifest-hits")
+    if self.config["assume-unchanged"]:
+      self.skipped(manfile, "assumed")
+      return False, manfile, False
+    # The listing's size and date columns can settle it without asking for the file
+    if manfile.rmtime and entry.mtime:
+      if manfile.rmtime == entry.mtime and entry.size_matches(manfile.dsize):
+        self.skipped(manfile, "listing")
+        return False, manfile, False
+      return True, manfile, True
+    return True, manfile, False
+
+  def get_listing(self, branch: str) -> (list, bool):
+    """
+      Fetches and parses a directory listing, reusing the last run's entries if it hasn't changed.
+
+      Returns the entries (None if the listing couldn't be fetched) and whether they're unchanged.
+    """
+    cached = self.listings.get(branch)
+    validators = {}
+    if cached and cached["etag"]:
+      validators["If-None-Match"] = cached["etag"]
+    if cached and cached["modified"]:
+      validators["If-Modified-Since"] = cached["modified"]
+    host = urlsplit(self.config["url"]).netloc
+    with self.metrics.timed("listing-fetch", host=host):
+      page = self.session.get(f"{self.config['url']}{branch}", headers=validators)
+    if page.status_code == 304 and cached:
+      self.metrics.count("listing-cache-hits")
+      return [ListingEntry(*x) for x in cached["entries"]], True
+    if not page.ok:
+      if page.status_code in self.retry_statuses:
+        raise RetryLater(f"Bad response ({page.status_code}) getting directory {branch}.", page)
+      print(f"Bad response ({page.status_code}) getting directory {branch}")
+      return None, False
+    # Plenty of servers don't send validators for generated listings, so compare the page itself
+    digest = hashlib.md5(page.content).hexdigest()
+    if cached and cached["digest"] == digest:
+      self.metrics.count("listing-cache-hits")
+      return [ListingEntry(*x) for x in cached["entries"]], True
+    self.metrics.count("listing-cache-misses")
+    with self.metrics.timed("listing-parse", host=host):
+      entries = self.parse_listing(page.text)
+    self.listings.put(branch, {
+      "etag" : page.headers.get("etag", ""),
+      "modified" : page.headers.get("last-modified", ""),
+      "digest" : digest,
+      "entries" : [x.dump() for x in entries],
+    })
+    return entries, False
+
+  def parse_listing(self, text: str) -> list:
+    """Pulls the links out of a directory listing with the first parser that recognizes its layout."""
+    for listing_parser in listing_parsers:
+      if listing_parser.name == self.config["listing-parser"] \
+          or (self.config["listing-parser"] == "auto" and listing_parser.matches(text)):
+        return listing_parser.parse(text)
+    return []
+
+  def queue_leaf(self, branch: str, leaf: str, manifest_file: 'DownloadFile' = None, listed: 'ListingEntry' = None, changed: bool = False, attempt: int = 0) -> None:
+    """Hands a leaf to the download workers, or writes it to the plan if we're only planning."""
+    if self.stopping.is_set():
+      return
+    if self.plan_file:
+      self.plan_leaf(branch, leaf, manifest_file, listed, changed)
+      return
+    if self.shard and not self.in_shard(os.path.join(branch, leaf)):
+      return
+    with self.pending_lock:
+      self.pending.append(self.pool.submit(self.get_leaf, branch, leaf, manifest_file, listed, changed, attempt))
+
+  def in_shard(self, target: str) -> bool:
+    """Whether a target path falls in this process's shard. Hashed, so shards come out about even."""
+    index, count = self.shard
+    return int(hashlib.md5(target.encode()).hexdigest(), 16) % count == index - 1
+
+  def plan_leaf(self, branch: str, leaf: str, manifest_file: 'DownloadFile' = None, listed: 'ListingEntry' = None, changed: bool = False) -> None:
+    """Writes a leaf to the plan, with what we know of its size and why it's needed."""
+    source = f"{self.config['url']}{branch}{leaf}"
+    if self.manifest.partial(source):
+      reason = "resume"
+    elif changed:
+      reason = "changed"
+    elif manifest_file:
+      # Probably unchanged, but only the server can say
+      reason = "check"
+    else:
+      reason = "new"
+    size = listed.size if listed and listed.size is not None else (manifest_file.dsize if manifest_file else None)
+    step = {
+      "source" : source,
+      "target" : os.path.join(self.config["path"], branch, leaf),
+      "size" : size,
+      "reason" : reason,
+      # What the executor needs to pick up where the walk left off
+      "branch" : branch,
+      "leaf" : leaf,
+      "mtime" : listed.mtime if listed else 0,
+      "size_slack" : listed.size_slack if listed else 0,
+    }
+    with self.plan_lock:
+      self.plan_file.write(f"{json.dumps(step)}\n")
+    self.metrics.count("files-planned", reason=reason)
+    if size:
+      self.metrics.count("bytes-planned", size, reason=reason)
+
+  def new_extractors(self) -> 'concurrent.futures.Executor':
+    """A pool of extraction workers in other processes, or threads if there's no way to run those."""
+    # Not fork(), which isn't safe once there are other threads, and a process running many jobs will have some
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    try:
+      return ProcessPoolExecutor(max(1, self.config["extract-workers"]), mp_context=multiprocessing.get_context(method))
+    except (ImportError, OSError): # No working process pools here
+      return ThreadPoolExecutor(max(1, self.config["extract-workers"]))
+
+  def queue_extract(self, F: 'DownloadFile') -> None:
+    """Hands a downloaded file to the extraction workers, waiting if too many are already queued."""
+    self.extract_slots.acquire()
+    job = (timed_call, F.extract, "", True, self.config["flat"], self.config["zip-workers"])
+    try:
+      with self.extractors_lock:
+        try:
+          future = self.extractors.submit(*job)
+        except BrokenExecutor:
+          # A worker died (e.g. killed for running out of memory) and took the pool with it, so start over with a new one
+          print("An extraction worker died. Starting new ones.")
+          self.extractors.shutdown(wait=False)
+          self.extractors = self.new_extractors()
+          future = self.extractors.submit(*job)
+    except Exception as e:
+      self.extract_slots.release()
+      self.metrics.count("errors", phase="extract")
+      print(f"Couldn't queue {F.lname} for expansion: {e}")
+      return
+    future.add_done_callback(lambda future: self.extracted(F, future))
+    with self.pending_lock:
+      self.extracting.append(future)
+
+  def extracted(self, F: 'DownloadFile', future) -> None:
+    """Records what came out of an archive once its extraction is done."""
+    self.extract_slots.release()
+    if future.exception():
+      self.metrics.count("errors", phase="extract")
+      print(f"Extraction failed: {future.exception()}")
+      return
+    out_files, seconds = future.result()
+    self.metrics.observe("extract", seconds)
+    if out_files is not None:
+      self.metrics.count("files-extracted", len(out_files))
+      F.out_files = out_files
+      self.manifest.upsert(F)
+
+  def finish_leaves(self) -> None:
+    """Waits for queued downloads to finish, works through the retry queue and reports anything that blew up."""
+    while True:
+      with self.pending_lock:
+        pending, self.pending = self.pending, []
+      if pending:
+        for future in wait(pending)[0]:
+          if future.exception():
+            self.metrics.count("errors", phase="download")
+            print(f"Download failed: {future.exception()}")
+        continue
+      with self.pending_lock:
+        if not self.retry_queue:
+          break
+        wait_for = self.retry_queue[0][0] - time.time()
+      if wait_for > 0:
+        time.sleep(wait_for)
+      with self.pending_lock:
+        due = []
+        while self.retry_queue and self.retry_queue[0][0] <= time.time():
+          due.append(heapq.heappop(self.retry_queue))
+      for _, attempt, branch, leaf, manifest_file, listed, changed in due:
+        self.queue_leaf(branch, leaf, manifest_file, listed, changed, attempt)
+    self.pool.shutdown()
+    # Nothing else can queue an extraction now
+    wait(self.extracting)
+    if self.extractors:
+      self.extractors.shutdown()
+
+  def host_slot(self, target: str) -> 'HostLimiter':
+    """Returns the limiter for simultaneous requests (and bandwidth) to the target's host."""
+    host = urlsplit(target).netloc
+    with self.host_slots_lock:
+      if host not in self.host_slots:
+        self.host_slots[host] = HostLimiter(max(1, self.config["host-connections"]), self.config["host-rate-limit"])
+      return self.host_slots[host]
+
+  def observe(self, r: 'requests.Response', *args, **kwargs) -> None:
+    """Response hook feeding each response's status and latency back to its host's limiter."""
+    host = urlsplit(r.url).netloc
+    self.metrics.observe("response", r.elapsed.total_seconds(), host=host)
+    self.metrics.count("responses", host=host, status=r.status_code)
+    self.host_slot(r.url).observe(r.status_code, r.elapsed.total_seconds(), retry_after(r))
+
+  def throttle(self, target: str, size: int) -> None:
+    """Waits until the global and per-host bandwidth caps allow another size bytes from the target."""
+    self.bandwidth.consume(size, self.stopping)
+    self.host_slot(target).bandwidth.consume(size, self.stopping)
+
+  def check_sample(self, F: 'DownloadFile', manifest_file: 'DownloadFile', validators: dict) -> bool:
+    """Whether a file with a sampled peek hash is unchanged, decided without downloading it."""
+    r = self.session.head(F.source, headers=validators, allow_redirects=True)
+    if r.status_code == 304:
       return True
+    if not r.ok:
+      return False
+    F.dsize = int(r.headers.get('content-length', 0))
+    F.etag = r.headers.get('etag', '')
+    F.modified = r.headers.get('last-modified', '')
+    if F.dsize != manifest_file.dsize:
+      return False
+    if validators and F.validated():
+      # Only fall back on the sample when the server can't say
+      return F.same_version(manifest_file)
+    F.peekpct = manifest_file.peekpct
+    F.peeksize = manifest_file.peeksize
+    if self.get_sample(F) != manifest_file.peekhash:
+      return False
+    return True
+
+  def refresh(self, manifest_file: 'DownloadFile', F: 'DownloadFile') -> None:
+    """Copies newer validators and listing details onto an unchanged file's record so the next check is cheaper."""
+    fresh = (F.etag or manifest_file.etag, F.modified or manifest_file.modified, F.rmtime or manifest_file.rmtime)
+    if fresh != (manifest_file.etag, manifest_file.modified, manifest_file.rmtime):
+      manifest_file.etag, manifest_file.modified, manifest_file.rmtime = fresh
+      self.manifest.upsert(manifest_file)
+
+  def get_sample(self, F: 'DownloadFile') -> str:
+    """Hashes a remote file's peek windows using Range requests, or returns None if the server won't serve ranges."""
+    peekhash = hashlib.md5()
+    for start, length in F.peek_windows():
+      # Ranges count raw bytes, so don't let the server compress them
+      r = self.session.get(F.source, stream=True, headers={
+        "Range": f"bytes={start}-{start + length - 1}",
+        "Accept-Encoding": "identity"
+      })
+      with r:
+        if r.status_code != 206:
+          return None
+        window = r.raw.read(length + 1)
+      if len(window) != length:
+        return None
+      peekhash.update(window)
+    return peekhash.hexdigest()
 
-  def get_stream(self, target: str) -> requests.Request:
-    return requests.get(
-      target,
-      headers=self.headers,
-      stream=True,
-      verify=not self.config["skip-cert-check"]
+  # Statuses worth trying again later rather than giving up on
+  retry_statuses = (408, 429, 500, 502, 503, 504)
+
+  def new_session(self) -> 'requests.Session':
+    """Builds a keep-alive session with pooled connections and retries on flaky responses."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    session.headers.update(self.headers)
+    session.verify = not self.config["skip-cert-check"]
+    adapter = HTTPAdapter(
+      # Every download worker should be able to hold a connection of its own
+      pool_maxsize=max(self.config["pool-size"], self.config["workers"]),
+      max_retries=Retry(
+        total=self.config["retries"],
+        backoff_factor=0.5,
+        # 429 and 503 mean slow down, which is the scheduler's job (see HostLimiter)
+        status_forcelist=(500, 502, 504),
+        respect_retry_after_header=False,
+        allowed_methods=("GET", "HEAD"),
+        raise_on_status=False
+      )
     )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.hooks["response"].append(self.observe)
+    return session
+
+  def get_stream(self, target: str, headers: dict = None) -> 'requests.Response':
+    return self.session.get(target, headers=headers, stream=True)
 
-  def get_leaf(self, branch: str, leaf: str, manifest_file: 'DownloadFile' = None) -> bool:
+  def get_leaf(self, branch: str, leaf: str, manifest_file: 'DownloadFile' = None, listed: 'ListingEntry' = None, changed: bool = False, attempt: int = 0) -> bool:
+    if self.stopping.is_set():
+      return False
     save_path = os.path.join(self.config['path'], branch)
     F = DownloadFile({
       'name' : leaf,
@@ -355,20 +915,119 @@ class Traverse(object):
       'source' : f"{self.config['url']}{branch}{leaf}",
       'peekpct' : self.config['peekpct'],
       'peeksize' : self.config['peeksize'],
+      'rmtime' : listed.mtime if listed and listed.mtime else 0,
+      # Replaced by the real size once we ask for the file
+      'dsize' : listed.size if listed and listed.size and not listed.size_slack else 0,
     })
 
-    if not os.path.exists(save_path):
-      os.makedirs(save_path)
+    os.makedirs(save_path, exist_ok=True)
 
-    r = self.get_stream(F.source)
-    if not r.ok:
-      print(f"Bad response ({r.status_code}) getting file {branch}{leaf}")
+    try:
+      with self.host_slot(F.source):
+        return self.fetch_leaf(F, branch, leaf, manifest_file, changed)
+    except (RetryLater, requests.RequestException) as e:
+      if attempt >= self.config["retries"]:
+        self.metrics.count("errors", phase="download", host=urlsplit(F.source).netloc)
+        print(f"Failed getting file {branch}{leaf}: {e} Giving up.")
+        self.listings.forget(branch)
+        self.file_event("failed", F)
+        return False
+      self.metrics.count("retries", host=urlsplit(F.source).netloc)
+      delay = self.retry_delay(e, attempt)
+      print(f"Failed getting file {branch}{leaf}: {e} Trying again in {delay:.0f}s.")
+      with self.pending_lock:
+        heapq.heappush(self.retry_queue, (time.time() + delay, attempt + 1, branch, leaf, manifest_file, listed, changed))
       return False
+    except BaseException:
+      # Don't let the next run skip this directory as unchanged
+      self.listings.forget(branch)
+      raise
+    finally:
+      # Hand back the local name if we didn't end up using it
+      F.release()
+
+  def retry_delay(self, e: Exception, attempt: int) -> float:
+    """How long to wait before trying again: whatever the server asked for, otherwise exponential backoff."""
+    return getattr(e, "delay", 0) or 2 ** attempt
 
-    F.dsize = int(r.headers.get('content-length'))
+  def fetch_leaf(self, F: 'DownloadFile', branch: str, leaf: str, manifest_file: 'DownloadFile' = None, changed: bool = False) -> bool:
+    # Pick up where an interrupted run left off if we can
+    partial = self.manifest.partial(F.source)
+    r, resumed = self.resume_stream(F, partial) if partial else (None, 0)
+    # Only bother comparing against what we have if the listing couldn't already tell us it changed
+    compare = manifest_file and not changed and not self.config["assume-unchanged"]
 
-    F.peekhash = hashlib.md5()
-    if manifest_file and F.dsize == manifest_file.dsize and not self.config["assume-unchanged"]:
+    if r is None:
+      # Let the server tell us if the file hasn't changed since we got it
+      validators = {}
+      if compare:
+        if manifest_file.etag:
+          validators["If-None-Match"] = manifest_file.etag
+        if manifest_file.modified:
+          validators["If-Modified-Since"] = manifest_file.modified
+
+      if compare and manifest_file.peekscheme == "sample":
+        # Sampled records are checked before committing to a download
+        if self.check_sample(F, manifest_file, validators):
+          print(f"File {branch}{leaf} is unchanged. Moving on...")
+          self.skipped(manifest_file, "sample")
+          self.refresh(manifest_file, F)
+          return True
+        # It changed, so there's nothing left to ask the server
+        validators = {}
+
+      if F.dsize and self.config["link-duplicates"] and self.config["sample-peek"]:
+        # The listing gave us a size, so a copy we already have may be spotted before downloading
+        if self.link_remote_copy(F, manifest_file):
+          print(f"File {branch}{leaf} matches a file we already have. Linked to it instead of downloading.")
+          self.skipped(F, "duplicate")
+          return True
+
+      r = self.get_stream(F.source, validators)
+      if r.status_code == 304:
+        print(f"File {branch}{leaf} is unchanged. Moving on...")
+        r.close()
+        self.skipped(manifest_file, "not-modified")
+        self.refresh(manifest_file, F)
+        return True
+      if not r.ok:
+        if r.status_code in self.retry_statuses:
+          raise RetryLater(f"Bad response ({r.status_code}) getting file {branch}{leaf}.", r)
+        print(f"Bad response ({r.status_code}) getting file {branch}{leaf}")
+        self.metrics.count("errors", phase="download", host=urlsplit(F.source).netloc)
+        self.listings.forget(branch)
+        self.file_event("failed", F)
+        return False
+
+      F.dsize = int(r.headers.get('content-length'))
+      F.etag = r.headers.get('etag', '')
+      F.modified = r.headers.get('last-modified', '')
+
+      # The listing may not have said, but the headers do
+      if not self.wanted_size(F.dsize) or (F.modified and self.newer_than and not self.wanted_date(http_date(F.modified))):
+        print(f"File {branch}{leaf} is filtered out by its size or date. Skipping it.")
+        r.close()
+        self.metrics.count("files-filtered")
+        self.file_event("filtered", F)
+        return True
+
+      # Servers that ignore conditional requests still tell us which version they're sending
+      if validators and F.dsize == manifest_file.dsize and F.same_version(manifest_file):
+        print(f"File {branch}{leaf} is unchanged. Moving on...")
+        r.close()
+        self.skipped(manifest_file, "validators")
+        self.refresh(manifest_file, F)
+        return True
+      if validators and F.validated():
+        # The server says this is another version, whatever its first bytes look like
+        compare = False
+
+    if resumed:
+      # We're committed to this version, so the peek hash is taken from disk afterwards
+      F.peekpct = partial.peekpct
+      peek_bytes = partial.peeksize
+      peek_hash = ""
+    elif compare and F.dsize == manifest_file.dsize and manifest_file.peekscheme == "prefix":
       F.peekpct = manifest_file.peekpct
       F.peeksize = manifest_file.peeksize
       peek_bytes = F.peeksize
@@ -380,8 +1039,8 @@ class Traverse(object):
       if peek_bytes > F.dsize:
         peek_bytes = F.dsize
       peek_hash = ""
-    peek_remainder = peek_bytes % self.config["chunksize"]
     F.peeksize = peek_bytes
+    peeker = WindowHasher([(0, peek_bytes)])
 
     pbar = None
     if self.config['progressbar']:
@@ -398,73 +1057,377 @@ class Traverse(object):
               progressbar.AdaptiveETA()
           ], maxval=F.dsize
       ).start()
+    elif resumed:
+      print(f"Resuming file {branch}{leaf} at {resumed} of {F.dsize} bytes...")
     else:
       print(f"Getting file {branch}{leaf} ({F.dsize } bytes)...")
 
+    if not resumed and not peek_hash and self.config["expand"] and self.config["stream-expand"] and F.streamable():
+      # Nothing to compare, so the archive can be expanded on the way in without ever landing on disk
+      return self.fetch_archive(F, branch, r, pbar)
+
     # Get the file
-    downloaded = 0
-    with open(os.path.join(save_path, F.lname + '.part'), 'wb') as f:
-      for chunk in r.iter_content(chunk_size=self.config["chunksize"]):
-        downloaded += len(chunk)
-        if downloaded <= F.dsize:
-          if pbar:
-            pbar.update(downloaded)
-        else:
-          print(f"\nWarning: Exceeded advertised size! {downloaded} > {F.dsize}")
-          if pbar:
-            pbar.update(F.dsize)
-        if downloaded <= F.peeksize - (peek_remainder):
-          F.peekhash.update(chunk)
-        elif downloaded == F.peeksize + (self.config["chunksize"] - peek_remainder):
-          F.peekhash.update(chunk[0:peek_remainder])
-        else:
-          if not type(F.peekhash) == str:
-            F.peekhash = F.peekhash.hexdigest()
+    # The local name can change once it's locked in below, so hang on to the path we're writing
+    part_path = partial.partial if resumed else os.path.join(F.path, F.lname + '.part')
+    if not resumed:
+      # Lets the next run resume this download if we don't finish it
+      self.manifest.upsert(F.partial_record(part_path))
+    downloaded = resumed
+    chasher = hashlib.new(self.config["content-hash"]) if self.config["content-hash"] else None
+    if chasher and resumed:
+      # The content hash has to cover what the last run already got
+      with open(part_path, 'rb') as f:
+        left = resumed
+        for block in iter(lambda: f.read(min(left, 1024 * 1024)), b""):
+          chasher.update(block)
+          left -= len(block)
+    host = urlsplit(F.source).netloc
+    # Time spent hashing and writing, so the rest of the transfer time can be put down to the network
+    hashing = writing = 0.0
+    started = time.perf_counter()
+    with open(part_path, 'r+b' if resumed else 'wb') as f:
+      f.seek(resumed)
+      if not peek_hash:
+        # Files that may turn out unchanged wait for the peek before taking up their space
+        self.preallocate(f, F.dsize)
+      checkpoint = downloaded + self.checkpoint_bytes
+      try:
+        for block in self.read_blocks(r, F.dsize - resumed):
+          size = len(block)
+          downloaded += size
+          self.throttle(F.source, size)
+          mark = time.perf_counter()
+          if chasher:
+            chasher.update(block)
+          if not resumed:
+            peeker.update(block)
+          hashing += time.perf_counter() - mark
+          if peek_hash and not F.peekhash and peeker.offset >= peek_bytes:
+            F.peekhash = peeker.hexdigest()
             if F.peekhash == peek_hash:
-              print("\nFile appears unchanged. Moving on...")
+              print(f"\nFile {branch}{leaf} appears unchanged. Moving on...")
               r.close()
-              os.remove(os.path.join(save_path, F.lname + '.part'))
+              f.close()
+              os.remove(part_path)
+              self.skipped(manifest_file, "peek")
+              self.manifest.upsert(DownloadFile({'source' : F.source})) # Nothing left to resume
+              self.refresh(manifest_file, F)
               return True
-        f.write(chunk)
-      r.close()
+            self.preallocate(f, F.dsize)
+          mark = time.perf_counter()
+          f.write(block)
+          writing += time.perf_counter() - mark
+          if downloaded > F.dsize and downloaded - size <= F.dsize:
+            print(f"\nWarning: Exceeded advertised size! {downloaded} > {F.dsize}")
+          if pbar:
+            pbar.update(min(downloaded, F.dsize))
+          if downloaded >= checkpoint:
+            # The file's preallocated, so its size doesn't say how much of it is real. The record does.
+            f.flush()
+            self.manifest.upsert(F.partial_record(part_path, downloaded))
+            checkpoint = downloaded + self.checkpoint_bytes
+      except BaseException:
+        # Whatever made it to disk can be resumed from
+        f.flush()
+        self.manifest.upsert(F.partial_record(part_path, downloaded))
+        raise
+      # Don't keep preallocated space the server didn't fill
+      f.truncate(downloaded)
+    r.close()
+    self.metrics.observe("transfer", time.perf_counter() - started, host=host)
+    self.metrics.observe("write", writing)
+    mark = time.perf_counter()
+    if resumed:
+      F.peekhash = F.prefix_hash(part_path)
+    elif not F.peekhash:
+      F.peekhash = peeker.hexdigest()
+    if self.config["sample-peek"]:
+      F.peekscheme = "sample"
+      F.peekhash = F.sample_hash(part_path)
+    if chasher:
+      F.chash = chasher.hexdigest()
+    self.metrics.observe("hash", hashing + time.perf_counter() - mark)
     if pbar:
       pbar.finish()
-    if manifest_file:
-      # Rebuild manifest without the superceded file
-      self.manifest = [x for x in self.manifest if not (x.peekhash == peek_hash and x.source == F.source)]
-      if self.config["delete-superceded"]:
+    with self.manifest_lock:
+      if manifest_file and self.config["delete-superceded"]:
+        F.release()
         F._lname = manifest_file._lname
         F.saved = True # Locks in the file's local name
-    os.rename(os.path.join(save_path, F.lname + '.part'), os.path.join(save_path, F.lname))
-    F.saved = True
-      
-    # Append to manifest
-    self.manifest.append(F)
-    # Write to disk to prevent lost information from early termination
-    with open(self.manifest_file, "a") as f:
-        f.write(f"{json.dumps(F.__dict__)},")
+      duplicate = self.manifest.find_content(F.chash) if self.config["link-duplicates"] and F.chash else None
+      if duplicate and self.link_copy(duplicate, os.path.join(F.path, F.lname)):
+        print(f"File {branch}{leaf} is a copy of {os.path.join(duplicate.path, duplicate.lname)}. Linked to it instead.")
+        self.metrics.count("files-linked")
+        os.remove(part_path)
+      else:
+        os.rename(part_path, os.path.join(F.path, F.lname))
+      F.saved = True
+
+    # Supersedes any earlier record for the same source, and is on disk right away in case we get cut short
+    self.manifest.upsert(F)
+    self.metrics.count("files-downloaded", host=host)
+    self.metrics.count("bytes-downloaded", downloaded - resumed, host=host)
+    self.file_event("downloaded", F)
     if self.config["expand"]:
-      F.extract()
+      self.queue_extract(F)
+    return True
+
+  # Most bytes a download gets between updates to its partial record
+  checkpoint_bytes = 64 * 1024 * 1024
+  # Largest read buffer per download worker
+  max_block = 8 * 1024 * 1024
+
+  def read_blocks(self, r: 'requests.Response', dsize: int):
+    """
+      Reads a response body in large blocks into a buffer reused by each worker, yielding a memoryview of each block.
+
+      A view is only good until the next one is asked for. Uncompressed bodies are read from the socket straight
+      into the buffer, while compressed ones have to go through urllib3 to be decoded. Blocks start out sized to
+      the file and double while they fill faster than they can usefully be handled.
+    """
+    size = min(self.max_block, max(self.config["chunksize"], dsize // 8))
+    buffer = getattr(self.buffers, "buffer", None)
+    direct = getattr(r.raw, "_original_response", None) if r.headers.get("content-encoding", "identity") == "identity" else None
+    try:
+      while True:
+        if buffer is None or len(buffer) < size:
+          buffer = self.buffers.buffer = bytearray(size)
+        view = memoryview(buffer)[:size]
+        started = time.perf_counter()
+        filled = 0
+        while filled < size:
+          if direct:
+            n = direct.readinto(view[filled:])
+          else:
+            data = r.raw.read(size - filled, decode_content=True)
+            n = len(data)
+            view[filled:filled + n] = data
+          if not n:
+            break
+          filled += n
+        if self.stopping.is_set():
+          raise Interrupted("Stopped before the download finished")
+        if filled:
+          yield view[:filled]
+        if filled < size:
+          break
+        if time.perf_counter() - started < 0.005 and size < self.max_block:
+          size = min(self.max_block, size * 2)
+    except (OSError, http.client.HTTPException, urllib3.exceptions.HTTPError) as e:
+      raise requests.ConnectionError(e)
+    if direct and direct.length:
+      # http.client doesn't complain when the connection drops before the end of the body, it just stops
+      raise requests.ConnectionError(f"Connection closed with {direct.length} bytes still to come")
+    if direct:
+      # urllib3 didn't see the body go by, so tell it the connection is free for the next request
+      r.raw.release_conn()
+
+  def preallocate(self, f: io.BufferedIOBase, size: int) -> None:
+    """Reserves disk space for a whole file up front, so it's laid out in one piece and a full disk shows up right away."""
+    if not size or not hasattr(os, "posix_fallocate"):
+      return
+    try:
+      os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+      if e.errno not in [errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS]:
+        raise
+
+  def fetch_archive(self, F: 'DownloadFile', branch: str, r: 'requests.Response', pbar: 'progressbar.ProgressBar' = None) -> bool:
+    """Expands an archive straight from the response, peek hashing the archive's own bytes as they pass."""
+    if self.config["sample-peek"]:
+      F.peekscheme = "sample"
+    hasher = WindowHasher(F.peek_ranges())
+    chasher = hashlib.new(self.config["content-hash"]) if self.config["content-hash"] else None
+    def chunks():
+      for chunk in r.iter_content(chunk_size=self.config["chunksize"]):
+        if self.stopping.is_set():
+          raise Interrupted("Stopped before the download finished")
+        self.throttle(F.source, len(chunk))
+        hasher.update(chunk)
+        if chasher:
+          chasher.update(chunk)
+        if pbar:
+          pbar.update(min(hasher.offset, F.dsize))
+        yield chunk
+    started = time.perf_counter()
+    with r:
+      out_files = F.extract_stream(chunks(), self.config["flat"])
+    # Downloading and expanding are interleaved here, so they're timed together
+    self.metrics.observe("transfer-extract", time.perf_counter() - started, host=urlsplit(F.source).netloc)
+    if pbar:
+      pbar.finish()
+    if out_files is None:
+      self.metrics.count("errors", phase="extract", host=urlsplit(F.source).netloc)
+      self.listings.forget(branch)
+      self.file_event("failed", F)
+      return False
+    F.peekhash = hasher.hexdigest()
+    if chasher:
+      F.chash = chasher.hexdigest()
+    F.out_files = out_files
+    # The archive itself is never saved, same as when it's expanded after downloading
+    F.saved = True
+    self.manifest.upsert(F)
+    self.metrics.count("files-downloaded", host=urlsplit(F.source).netloc)
+    self.metrics.count("bytes-downloaded", hasher.offset, host=urlsplit(F.source).netloc)
+    self.metrics.count("files-extracted", len(out_files))
+    self.file_event("downloaded", F)
     return True
 
+  def link_copy(self, original: 'DownloadFile', target: str) -> bool:
+    """Hardlinks a target path to an already mirrored file with the same content. Returns False if that's not possible."""
+    source = os.path.join(original.path, original.lname)
+    if not os.path.isfile(source):
+      # e.g. an archive that has since been expanded
+      return False
+    try:
+      os.link(source, f"{target}.link")
+      os.replace(f"{target}.link", target)
+    except OSError: # Different filesystem, or no hardlinks here
+      if os.path.exists(f"{target}.link"):
+        os.remove(f"{target}.link")
+      return False
+    return True
+
+  def link_remote_copy(self, F: 'DownloadFile', manifest_file: 'DownloadFile' = None) -> bool:
+    """Links a file instead of downloading it if its size and sampled windows match a file we already have."""
+    candidates = self.manifest.find_size(F.dsize)
+    for peeksize in set(x.peeksize for x in candidates):
+      # Sampled on a stand-in, so F is left as it was if nothing matches
+      probe = DownloadFile({'source' : F.source, 'dsize' : F.dsize, 'peeksize' : peeksize, 'peekscheme' : "sample"})
+      peekhash = self.get_sample(probe)
+      if peekhash is None:
+        return False
+      for original in candidates:
+        if original.peeksize == peeksize and original.peekhash == peekhash:
+          with self.manifest_lock:
+            # Same as a download, a new version takes the old one's place if superseded files go
+            superseding = manifest_file and self.config["delete-superceded"]
+            lname = manifest_file._lname if superseding else F.lname
+            if not self.link_copy(original, os.path.join(F.path, lname)):
+              continue
+            if superseding:
+              F.release()
+              F._lname = lname
+            F.saved = True
+          F.peeksize = peeksize
+          F.peekscheme = "sample"
+          F.peekpct = original.peekpct
+          F.peekhash = peekhash
+          F.chash = original.chash
+          self.manifest.upsert(F)
+          return True
+    return False
+
+  def resume_stream(self, F: 'DownloadFile', partial: 'DownloadFile') -> ('requests.Response', int):
+    """
+      Requests the rest of an interrupted download.
+
+      Returns the response and the offset it starts at, or (None, 0) if the download has to start over.
+    """
+    try:
+      size = os.path.getsize(partial.partial)
+    except OSError:
+      return None, 0
+    # Preallocated files are full size from the start, so go by how much the record says arrived
+    offset = size if partial.received is None else min(partial.received, size)
+    # If-Range needs a strong validator, otherwise the server could splice two versions together
+    validator = partial.etag if partial.etag and partial.etag[:2] != "W/" else partial.modified
+    if not offset or not validator:
+      return None, 0
+    # Ranges count raw bytes, so don't let the server compress them
+    r = self.get_stream(F.source, {
+      "Range": f"bytes={offset}-",
+      "If-Range": validator,
+      "Accept-Encoding": "identity"
+    })
+    if r.status_code != 206 or not r.headers.get('content-range', '').startswith(f"bytes {offset}-"):
+      # No ranges, or the file changed since
+      r.close()
+      return None, 0
+    F.dsize = int(r.headers['content-range'].rsplit('/', 1)[-1])
+    F.etag = partial.etag
+    F.modified = partial.modified
+    F.peekscheme = partial.peekscheme
+    return r, offset
+
 class DownloadFile(object):
+  # Local names handed out to files that aren't on disk yet, shared by all downloads
+  _reserved = {}
+  _reserved_lock = threading.RLock()
+
+  # Everything a record holds, with defaults. Slots instead of a __dict__ keep big manifests small.
+  fields = {
+    'name' : '',
+    'path' : '',
+    'source' : '',
+    'dsize' : 0,
+    # Validators from the server, if it gave us any
+    'etag' : '',
+    'modified' : '',
+    'peekhash' : '',
+    'peekpct' : 0,
+    'peeksize' : 0,
+    # How peekhash was taken: "prefix" for the start of the file, "sample" for windows across it
+    'peekscheme' : 'prefix',
+    # Modification time shown in the directory listing, if it had one
+    'rmtime' : 0,
+    # Hash of the whole file's content, if content hashing was on when it was downloaded
+    'chash' : '',
+    # Path of the .part file if this records an unfinished download
+    'partial' : '',
+    # Bytes of the .part file that hold data so far
+    'received' : None,
+    'saved' : False,
+    '_lname' : '',
+    # What an expanded archive turned into
+    'out_files' : None,
+  }
+  __slots__ = tuple(fields)
+  _defaults = tuple(fields.items())
+
   def __init__(self, dlfile: dict = {}, *args, **kwargs):
-    # Deserialize imported file object automagically
-    self.__dict__.update(dlfile)
-    # These properties always need to exist
-    self.name = getattr(self, 'name', '')
-    self.path = getattr(self, 'path', '')
-    self.source = getattr(self, 'source', '')
-    self.dsize = getattr(self, 'dsize', 0)
-    # Populate other property values
-    self.lname
+    # Deserialize imported file object automagically, dropping anything we no longer keep
+    get = dlfile.get
+    for field, default in self._defaults:
+      setattr(self, field, get(field, default))
+    # Thousands of records share each directory, so share the string too
+    self.path = sys.intern(self.path)
+    self.peekscheme = sys.intern(self.peekscheme)
+    if self.name and not (self.saved and self._lname):
+      # Pick a local name
+      self.lname
+
+  def to_dict(self) -> dict:
+    """The record's fields that differ from their defaults, for writing to the manifest."""
+    return {field : getattr(self, field) for field, default in self.fields.items() if getattr(self, field) != default}
 
   @property
   def lname(self) -> str:#filename
     """The local file name if saved, otherwise a dynamically generated candidate."""
-    if not getattr(self, 'saved', False) or not getattr(self, '_lname', ''):
-      self._lname = self.get_unique_fname(self.path, self.name)
+    if not self.saved or not self._lname:
+      with DownloadFile._reserved_lock:
+        # Candidates are reserved so concurrent downloads can't pick the same one
+        self.release()
+        self._lname = self.get_unique_fname(self.path, self.name)
+        if self.name:
+          DownloadFile._reserved[os.path.join(self.path, self._lname)] = self
+    elif self._reserved_path:
+      # It's on disk now, so the reservation is no longer needed
+      self.release()
     return self._lname
+
+  @property
+  def _reserved_path(self) -> str:
+    """The path this file has reserved as its local name, if any."""
+    path = os.path.join(self.path, self._lname)
+    return path if DownloadFile._reserved.get(path) is self else ''
+
+  def release(self) -> None:
+    """Gives up this file's reserved local name."""
+    with DownloadFile._reserved_lock:
+      if self._reserved_path:
+        del DownloadFile._reserved[self._reserved_path]
   
   @property
   def lsize(self) -> int:#bytes
@@ -474,14 +1437,82 @@ class DownloadFile(object):
     except: # Probably not saved, don't care
       return 0
 
+  def validated(self) -> bool:
+    """Whether the server sent anything to tell versions of the file apart by."""
+    return bool(self.etag or self.modified)
+
+  def same_version(self, other: 'DownloadFile') -> bool:
+    """Whether the server's validators say both records describe the same version of the file."""
+    if self.etag and other.etag:
+      return self.etag == other.etag
+    return bool(self.modified) and self.modified == other.modified
+
+  def partial_record(self, part_path: str, received: int = 0) -> 'DownloadFile':
+    """A record of this file's unfinished download, with what's needed to resume it safely."""
+    return DownloadFile({
+      'path' : self.path,
+      'source' : self.source,
+      'dsize' : self.dsize,
+      'etag' : self.etag,
+      'modified' : self.modified,
+      'peekpct' : self.peekpct,
+      'peeksize' : self.peeksize,
+      'peekscheme' : self.peekscheme,
+      'rmtime' : self.rmtime,
+      'partial' : part_path,
+      'received' : received,
+    })
+
+  def prefix_hash(self, filepath: str) -> str:
+    """Hashes the first peeksize bytes of a local copy of the file."""
+    with open(filepath, "rb") as f:
+      return hashlib.md5(f.read(self.peeksize)).hexdigest()
+
+  def peek_ranges(self) -> list:
+    """(offset, length) pairs covered by the peek hash under this file's peek scheme."""
+    if self.peekscheme == "sample":
+      return self.peek_windows()
+    return [(0, min(self.peeksize, self.dsize))]
+
+  def peek_windows(self) -> list:
+    """(offset, length) pairs covering peeksize bytes, split between the head, middle and tail of the file."""
+    if self.peeksize >= self.dsize:
+      return [(0, self.dsize)] if self.dsize else []
+    length = -(-self.peeksize // 3)
+    return [(0, length), ((self.dsize - length) // 2, length), (self.dsize - length, length)]
+
+  def sample_hash(self, filepath: str) -> str:
+    """Hashes the peek windows of a local copy of the file."""
+    peekhash = hashlib.md5()
+    with open(filepath, "rb") as f:
+      for start, length in self.peek_windows():
+        f.seek(start)
+        peekhash.update(f.read(length))
+    return peekhash.hexdigest()
+
   def get_unique_fname(self, filepath: str, filename: str) -> str:
     """Returns a unique (non-pre-existing) filename for a given filename and path."""
     basename, ext = self.get_fext(filename, extpartlim=2)
     i = 0
-    while os.path.exists(os.path.join(filepath, f"{basename} ({i}){ext}" if i else filename)):
+    while os.path.exists(os.path.join(filepath, f"{basename} ({i}){ext}" if i else filename)) \
+        or os.path.join(filepath, f"{basename} ({i}){ext}" if i else filename) in DownloadFile._reserved:
       i += 1
     return f"{basename} ({i}){ext}" if i else filename
 
+  def claim_fname(self, filepath: str, filename: str) -> str:
+    """
+      Returns a unique filename like get_unique_fname(), and creates it empty to hold onto it.
+
+      Extractions run in several processes at once, so the name has to be taken on disk rather than just picked.
+    """
+    while True:
+      fname = self.get_unique_fname(filepath, filename)
+      try:
+        os.close(os.open(os.path.join(filepath, fname), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return fname
+      except FileExistsError:
+        continue
+
   def get_fext(self, filename: str, extlim: int = -1, extpartlim: int = None) -> (str, str):
     """
       Returns name and extension parts for a given filename.
@@ -504,7 +1535,195 @@ class DownloadFile(object):
       ext = ext2 + ext
     return filename, ext
 
-  def extract(self, file: str = "", loop: bool = True) -> bool:
+  def streamable(self) -> bool:
+    """Whether the file can be expanded as it downloads (compressed files and tar archives, not ZIPs)."""
+    f_base, f_ext = os.path.splitext(self.name)
+    return f_ext in [".gz", ".tar", ".tgz"]
+
+  def extract_stream(self, chunks: 'iterator', flat: bool = False) -> list:
+    """
+      Expands a compressed file or tar archive from an iterator of its bytes, without saving the archive itself.
+
+      Returns the expanded files (relative to the file's directory), or None if it couldn't be expanded.
+    """
+    import tarfile, zlib
+
+    f_base, f_ext = os.path.splitext(self.name)
+    out_files = []
+    def discard() -> None:
+      # Take back whatever made it out, including names claimed but not yet written
+      for fname in out_files:
+        for leftover in [fname, f"{fname}.part"]:
+          if os.path.exists(os.path.join(self.path, leftover)):
+            os.remove(os.path.join(self.path, leftover))
+
+    # TAR archives, compressed or not
+    if f_ext in [".tar", ".tgz"] or os.path.splitext(f_base)[1] == ".tar":
+      print(f"Expanding TAR archive {self.name} as it downloads.")
+      try:
+        with tarfile.open(fileobj=ChunkReader(chunks), mode="r|*") as tar:
+          for member in tar:
+            if member.isreg():
+              if flat:
+                # Strip any path information from members
+                member.name = self.claim_fname(self.path, os.path.basename(member.name))
+              out_files.append(member.name)
+              tar.extract(member, self.path)
+      except (requests.RequestException, Interrupted):
+        # The download failed rather than the archive, so it's worth another try
+        discard()
+        raise
+      except Exception:
+        discard()
+        print(f"Unable to expand TAR archive {self.name}. Something is wrong with it.")
+        return None
+
+    # GZIP compression
+    else:
+      print(f"Expanding GZIP compressed file {self.name} as it downloads.")
+      out_fname = self.claim_fname(self.path, f_base)
+      out_files.append(out_fname)
+      try:
+        with open(os.path.join(self.path, out_fname + ".part"), "wb") as f_out:
+          decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+          for chunk in chunks:
+            f_out.write(decompressor.decompress(chunk))
+            # Concatenated gzip members are still one file
+            while decompressor.eof and decompressor.unused_data:
+              chunk = decompressor.unused_data
+              decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+              f_out.write(decompressor.decompress(chunk))
+          f_out.write(decompressor.flush())
+        if not decompressor.eof:
+          raise zlib.error("Truncated stream")
+        os.rename(os.path.join(self.path, out_fname + ".part"), os.path.join(self.path, out_fname))
+      except (requests.RequestException, Interrupted):
+        discard()
+        raise
+      except Exception:
+        discard()
+        print(f"Unable to expand GZIP file {self.name}. It's likely malformed.")
+        return None
+
+    return out_files
+
+  def extract_zip(self, file: str, flat: bool = False, workers: int = 1) -> list:
+    """
+      Expands a ZIP archive into the file's directory, several members at a time.
+
+      Each thread reads through a ZipFile of its own, and CRCs are checked as members are written instead of in a pass
+      of their own. Members already on disk with the same size and CRC, e.g. from an earlier version of the archive,
+      are left alone. Nothing is moved into place unless every member checks out.
+
+      Returns the files (relative to the file's directory). Raises zipfile.BadZipFile if the archive is bad.
+    """
+    import zipfile, shutil
+
+    archive = os.path.join(self.path, file)
+    with zipfile.ZipFile(archive) as zip:
+      members = zip.infolist()
+
+    out_files = []
+    writes = [] # (member, name) still to be written
+    claimed = [] # Names taken with claim_fname(), to give back if it comes to nothing
+    created = [] # Directories made along the way, likewise
+    def make_dirs(directory: str) -> None:
+      missing = []
+      while not os.path.isdir(directory):
+        missing.append(directory)
+        directory = os.path.dirname(directory)
+      for directory in reversed(missing):
+        os.mkdir(directory)
+        created.append(directory)
+
+    handles = threading.local()
+    opened = []
+    def expand(member: zipfile.ZipInfo, name: str) -> None:
+      if not hasattr(handles, "zip"):
+        handles.zip = zipfile.ZipFile(archive)
+        opened.append(handles.zip)
+      # Reading a member to the end raises BadZipFile if its CRC is wrong
+      with handles.zip.open(member) as f_in, open(os.path.join(self.path, f"{name}.part"), "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+
+    pool = ThreadPoolExecutor(max(1, workers))
+    try:
+      for member in members:
+        # Same as zipfile's own extract(), nothing gets out of the file's directory
+        parts = [x for x in re.split(r"[/\\]", member.filename) if x not in ["", ".", ".."]]
+        if not parts:
+          continue
+        if member.is_dir():
+          if not flat:
+            make_dirs(os.path.join(self.path, *parts))
+          continue
+        name = parts[-1] if flat else os.path.join(*parts)
+        candidates = [name]
+        if flat:
+          # An earlier expansion may have had to give this member one of the (1), (2)... names
+          basename, ext = self.get_fext(name, extpartlim=2)
+          while os.path.exists(os.path.join(self.path, f"{basename} ({len(candidates)}){ext}")):
+            candidates.append(f"{basename} ({len(candidates)}){ext}")
+        present = [x for x in candidates if x not in out_files and self.zip_member_present(os.path.join(self.path, x), member)]
+        if present:
+          out_files.append(present[0])
+          continue
+        if flat:
+          # Strip any path information from members
+          name = self.claim_fname(self.path, name)
+          claimed.append(name)
+        else:
+          make_dirs(os.path.dirname(os.path.join(self.path, name)))
+        out_files.append(name)
+        writes.append((member, name))
+
+      # Biggest first, so one large member doesn't start last and hold everything up
+      writes.sort(key=lambda x: -x[0].compress_size)
+      for future in [pool.submit(expand, member, name) for member, name in writes]:
+        future.result()
+    except BaseException:
+      pool.shutdown(cancel_futures=True)
+      for member, name in writes:
+        if os.path.exists(os.path.join(self.path, f"{name}.part")):
+          os.remove(os.path.join(self.path, f"{name}.part"))
+      for name in claimed:
+        os.remove(os.path.join(self.path, name))
+      for directory in reversed(created):
+        try:
+          os.rmdir(directory)
+        except OSError: # Not ours to remove if something else went in
+          pass
+      raise
+    finally:
+      pool.shutdown()
+      for zip in opened:
+        zip.close()
+
+    for member, name in writes:
+      os.replace(os.path.join(self.path, f"{name}.part"), os.path.join(self.path, name))
+    return out_files
+
+  def zip_member_present(self, filepath: str, member: 'zipfile.ZipInfo') -> bool:
+    """Whether a ZIP member is already on disk, going by its size and CRC."""
+    import zlib
+
+    try:
+      if os.path.getsize(filepath) != member.file_size:
+        return False
+      crc = 0
+      with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+          crc = zlib.crc32(block, crc)
+      return crc == member.CRC
+    except OSError:
+      return False
+
+  def extract(self, file: str = "", loop: bool = True, flat: bool = False, workers: int = 1) -> list:
+    """
+      Expands an archive or compressed file in place, then removes it.
+
+      Returns the expanded files (relative to the file's directory), or None if nothing was expanded.
+    """
     import zipfile, gzip, tarfile, shutil
 
     out_files = []
@@ -516,33 +1735,21 @@ class DownloadFile(object):
     if f_ext == ".zip":
       print(f"Expanding ZIP archive {file}.")
       try:
-        with zipfile.ZipFile(os.path.join(self.path, file)) as zip:
-          # testzip() returns None or name of first bad file
-          if zipfile.ZipFile.testzip(zip) is not None:
-            print("Malformed ZIP or contents corrupted! Unable to process.")
-            return False
-          if self.config["flat"]:
-            # Not using extractall() because we don't want a tree structure
-            for member in zip.infolist():
-              member = self.get_unique_fname(self.path, member)
-              if self.config["flat"]:
-                zip.extract(member, self.path)
-              else:
-                zip.extract(member)
-              out_files.append(str(member))
-          else:
-            zip.extractall(self.path)
-          # Delete the zip file now that we have its contents
+        out_files = self.extract_zip(file, flat, workers)
+        # Delete the zip file now that we have its contents
         os.remove(os.path.join(self.path, file))
+      except zipfile.BadZipFile:
+        print(f"Malformed ZIP or contents corrupted! Unable to process {file}.")
+        return None
       except:
         print(f"Unable to expand ZIP archive {file}. You should check its headers or something.")
-        return False
+        return None
 
     # GZIP compression
     elif f_ext == ".gz":
       print(f"Expanding GZIP compressed file {file}.")
       try:
-        out_fname = self.get_unique_fname(self.path, f_base)
+        out_fname = self.claim_fname(self.path, f_base)
         with gzip.open(os.path.join(self.path, file), "rb") as f_in, open(os.path.join(self.path, out_fname), "wb") as f_out:
           shutil.copyfileobj(f_in, f_out)
         out_files.append(out_fname)
@@ -550,45 +1757,1017 @@ class DownloadFile(object):
         os.remove(os.path.join(self.path, file))
       except:
         print(f"Unable to expand GZIP file {file}. It's likely malformed.")
-        return False
+        return None
 
     # TAR archives
     elif f_ext == ".tar":
       print(f"Expanding TAR archive {file}.")
       try:
         with tarfile.open(os.path.join(self.path, file), "r") as tar:
-          if self.config["flat"]:
-            # Not using extractall() because we don't want a tree structure
-            for member in tar.getmembers():
-              if member.isreg():
-                if self.config["flat"]:
-                  # Strip any path information from members
-                  member.name = self.get_unique_fname(self.path, os.path.basename(member.name))
-                tar.extract(member, self.path)
-                out_files.append(member.name)
+          # Not using extractall() because we only want regular files
+          for member in tar.getmembers():
+            if member.isreg():
+              if flat:
+                # Strip any path information from members
+                member.name = self.claim_fname(self.path, os.path.basename(member.name))
+              tar.extract(member, self.path)
+              out_files.append(member.name)
         # Delete the tar file now that we have its contents
         os.remove(os.path.join(self.path, file))
       except:
         print(f"Unable to expand TAR archive {file}. Something is wrong with it.")
+        return None
     
     # The file is not compressed or archived, or not a supported format
     else:
-      return
+      return None
     
     if not loop:
-      return
+      return out_files
     
     # Iterate back through, in case of layered archives or compressed archives (e.g. example.tar.gz)
+    expanded = []
     for file in out_files:
       # Set loop switch to False to avoid creating blackhole
-      self.extract(file, False)
+      nested = self.extract(file, False, flat, workers)
+      expanded += [file] if nested is None else nested
+    return expanded
   
-if __name__ == "__main__":
+def sync_dir(path: str) -> None:
+  """Syncs the directory holding path, so a rename into it survives a crash."""
+  try:
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+  except OSError: # Not something every platform allows
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
+def timed_call(func, *args, **kwargs) -> tuple:
+  """Calls func and returns its result along with how long it took. For timing work done in other processes."""
+  started = time.perf_counter()
+  result = func(*args, **kwargs)
+  return result, time.perf_counter() - started
+
+class Metrics(object):
+  """
+    Counters, gauges and latency histograms for a run, each optionally labelled (by host, phase, status...).
+
+    Callers can subscribe(callback) to be told about every update as callback(kind, name, value, labels),
+    with kind one of "count", "set" or "observe". Callbacks run on whichever thread made the update.
+  """
+  # Upper bounds of the latency histogram buckets, in seconds
+  buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+  def __init__(self, *args, **kwargs):
+    self.started = time.time()
+    self.clock = time.perf_counter()
+    self.counters = {}
+    self.gauges = {}
+    # (name, labels) -> [bucket counts..., total seconds, observations]
+    self.histograms = {}
+    self.hooks = []
+    self.lock = threading.Lock()
+
+  def subscribe(self, callback) -> None:
+    self.hooks.append(callback)
+
+  def notify(self, kind: str, name: str, value: float, labels: dict) -> None:
+    for hook in self.hooks:
+      hook(kind, name, value, labels)
+
+  def count(self, name: str, amount: float = 1, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + amount
+    self.notify("count", name, amount, labels)
+
+  def set(self, name: str, value: float, **labels) -> None:
+    with self.lock:
+      self.gauges[(name, tuple(sorted(labels.items())))] = value
+    self.notify("set", name, value, labels)
+
+  def observe(self, name: str, seconds: float, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      histogram = self.histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+      for i, bound in enumerate(self.buckets):
+        if seconds <= bound:
+          histogram[i] += 1
+          break
+      histogram[-2] += seconds
+      histogram[-1] += 1
+    self.notify("observe", name, seconds, labels)
+
+  @contextlib.contextmanager
+  def timed(self, name: str, **labels):
+    """Observes how long the block takes."""
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - started, **labels)
+
+  def total(self, name: str, **labels) -> float:
+    """Sums a counter over every label set that includes the given labels."""
+    with self.lock:
+      return sum(value for (key, key_labels), value in self.counters.items()
+        if key == name and set(labels.items()) <= set(key_labels))
+
+  def report(self) -> dict:
+    """The run so far as a JSON-ready dict: a summary up top, then every metric with its labels."""
+    elapsed = time.perf_counter() - self.clock
+    hits, misses = self.total("listing-cache-hits"), self.total("listing-cache-misses")
+    known, new = self.total("manifest-hits"), self.total("manifest-misses")
+    with self.lock:
+      histograms = {key: list(value) for key, value in self.histograms.items()}
+      counters = dict(self.counters)
+      gauges = dict(self.gauges)
+    phases = {}
+    for (name, labels), histogram in histograms.items():
+      phase = phases.setdefault(name, {"seconds" : 0.0, "count" : 0})
+      phase["seconds"] += histogram[-2]
+      phase["count"] += histogram[-1]
+    return {
+      "started" : datetime.fromtimestamp(self.started).isoformat(),
+      "elapsed" : elapsed,
+      "summary" : {
+        "files-downloaded" : self.total("files-downloaded"),
+        "bytes-downloaded" : self.total("bytes-downloaded"),
+        "files-skipped" : self.total("files-skipped"),
+        "bytes-skipped" : self.total("bytes-skipped"),
+        "files-per-second" : self.total("files-downloaded") / elapsed if elapsed else 0,
+        "bytes-per-second" : self.total("bytes-downloaded") / elapsed if elapsed else 0,
+        "listing-cache-hit-rate" : hits / (hits + misses) if hits + misses else None,
+        "manifest-hit-rate" : known / (known + new) if known + new else None,
+        "errors" : self.total("errors"),
+        "retries" : self.total("retries"),
+      },
+      "phases" : phases,
+      "counters" : [{"name" : name, "labels" : dict(labels), "value" : value} for (name, labels), value in counters.items()],
+      "gauges" : [{"name" : name, "labels" : dict(labels), "value" : value} for (name, labels), value in gauges.items()],
+      "histograms" : [{
+          "name" : name,
+          "labels" : dict(labels),
+          "buckets" : {str(bound) : count for bound, count in zip(self.buckets, histogram)},
+          "seconds" : histogram[-2],
+          "count" : histogram[-1],
+        } for (name, labels), histogram in histograms.items()],
+    }
+
+  def prometheus(self) -> str:
+    """The run so far in Prometheus text exposition format, as read by node_exporter's textfile collector."""
+    def metric(name: str) -> str:
+      return "autotraverse_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+    def label_text(labels, extra=()) -> str:
+      pairs = [f'{key}="{str(value).translate(escapes)}"' for key, value in tuple(labels) + tuple(extra)]
+      return "{" + ",".join(pairs) + "}" if pairs else ""
+    escapes = str.maketrans({"\\" : "\\\\", '"' : '\\"', "\n" : "\\n"})
+    with self.lock:
+      counters = sorted(self.counters.items())
+      gauges = sorted(self.gauges.items())
+      histograms = sorted(self.histograms.items())
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+      if name not in typed:
+        lines.append(f"# TYPE {metric(name)}_total counter")
+        typed.add(name)
+      lines.append(f"{metric(name)}_total{label_text(labels)} {value}")
+    for (name, labels), value in gauges:
+      if name not in typed:
+        lines.append(f"# TYPE {metric(name)} gauge")
+        typed.add(name)
+      lines.append(f"{metric(name)}{label_text(labels)} {value}")
+    for (name, labels), histogram in histograms:
+      if name not in typed:
+        lines.append(f"# TYPE {metric(name)}_seconds histogram")
+        typed.add(name)
+      cumulative = 0
+      for bound, count in zip(self.buckets, histogram):
+        cumulative += count
+        lines.append(f"{metric(name)}_seconds_bucket{label_text(labels, [('le', '+Inf' if bound == float('inf') else bound)])} {cumulative}")
+      lines.append(f"{metric(name)}_seconds_sum{label_text(labels)} {histogram[-2]}")
+      lines.append(f"{metric(name)}_seconds_count{label_text(labels)} {histogram[-1]}")
+    lines.append("# TYPE autotraverse_last_run_timestamp_seconds gauge")
+    lines.append(f"autotraverse_last_run_timestamp_seconds {self.started}")
+    return "\n".join(lines) + "\n"
+
+class RunResult(object):
+  """
+    What Traverse.run() hands back: whether the job went through, and the run report's summary and phases.
+
+    ok is False if anything failed for good (a download, listing or extraction), with failed saying how many did.
+  """
+  def __init__(self, ok: bool, report: dict, *args, **kwargs):
+    self.ok = ok
+    self.report = report
+    self.summary = report["summary"]
+    self.failed = int(self.summary["errors"])
+
+class Interrupted(Exception):
+  """The run was stopped while this was still going."""
+
+class ManifestError(Exception):
+  """The manifest can't be read."""
+
+class RetryLater(Exception):
+  """A request failed in a way that's worth trying again later."""
+  def __init__(self, message: str, r: 'requests.Response' = None, *args, **kwargs):
+    super().__init__(message)
+    self.delay = retry_after(r) if r is not None else 0
+
+def http_date(value: str) -> int:
+  """Seconds since the epoch for an HTTP date header, or 0 if it can't be read."""
+  try:
+    return int(email.utils.parsedate_to_datetime(value).timestamp())
+  except (TypeError, ValueError):
+    return 0
+
+def retry_after(r: 'requests.Response') -> float:
+  """Seconds the server asked us to wait through Retry-After, or 0."""
+  value = r.headers.get("retry-after", "")
+  if value.isdigit():
+    return float(value)
   try:
-    t = Traverse(config)
-    t.traverse()
+    return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return 0.0
+
+class TokenBucket(object):
+  """Caps throughput at rate bytes per second, allowing bursts of up to a second's worth. A rate of 0 means no cap."""
+  def __init__(self, rate: int, *args, **kwargs):
+    self.rate = rate
+    self.tokens = rate
+    self.stamp = time.monotonic()
+    self.lock = threading.Lock()
+
+  def consume(self, amount: int, stop: threading.Event = None) -> None:
+    """Takes amount tokens, sleeping off any debt that leaves (or until stop is set)."""
+    if not self.rate:
+      return
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate) - amount
+      self.stamp = now
+      debt = -self.tokens / self.rate if self.tokens < 0 else 0
+    if debt:
+      stop.wait(debt) if stop else time.sleep(debt)
+
+class HostLimiter(object):
+  """
+    Caps simultaneous requests to one host and adapts the cap to how the host is coping.
+
+    Additive increase, multiplicative decrease: the cap grows by one for every cap's worth of prompt
+    responses, and shrinks when the host answers 429/503 or gets much slower than its best. New
+    requests also wait out any Retry-After the host sends.
+  """
+  def __init__(self, maximum: int, rate: int = 0, *args, **kwargs):
+    self.maximum = maximum
+    self.limit = float(maximum)
+    self.active = 0
+    self.paused_until = 0
+    self.fastest = None
+    self.latency = None
+    self.last_decrease = 0
+    self.bandwidth = TokenBucket(rate)
+    self.condition = threading.Condition()
+
+  def __enter__(self) -> 'HostLimiter':
+    with self.condition:
+      while True:
+        paused = self.paused_until - time.time()
+        if paused > 0:
+          self.condition.wait(paused)
+        elif self.active >= int(self.limit):
+          self.condition.wait()
+        else:
+          break
+      self.active += 1
+    return self
+
+  def __exit__(self, *args) -> None:
+    with self.condition:
+      self.active -= 1
+      self.condition.notify_all()
+
+  def observe(self, status: int, latency: float, retry_after: float = 0) -> None:
+    """Adjusts the cap after a response."""
+    with self.condition:
+      now = time.time()
+      if status in (429, 503):
+        self.paused_until = max(self.paused_until, now + retry_after)
+        self.decrease(now, 0.5)
+      else:
+        self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.latency > 4 * max(self.fastest, 0.05):
+          self.decrease(now, 0.75)
+        else:
+          self.limit = min(self.maximum, self.limit + 1 / self.limit)
+      self.condition.notify_all()
+
+  def decrease(self, now: float, factor: float) -> None:
+    # Requests already in flight will all report the same trouble, so only back off once per round trip
+    if now - self.last_decrease > (self.latency or 1):
+      self.limit = max(1.0, self.limit * factor)
+      self.last_decrease = now
+
+class WindowHasher(object):
+  """Hashes whatever parts of a stream fall inside a set of sorted, non-overlapping (offset, length) windows."""
+  def __init__(self, windows: list, *args, **kwargs):
+    self.windows = windows
+    self.hash = hashlib.md5()
+    self.offset = 0
+
+  def update(self, chunk: bytes) -> None:
+    end = self.offset + len(chunk)
+    for start, length in self.windows:
+      low, high = max(start, self.offset), min(start + length, end)
+      if low < high:
+        self.hash.update(chunk[low - self.offset:high - self.offset])
+    self.offset = end
+
+  def hexdigest(self) -> str:
+    return self.hash.hexdigest()
+
+class ChunkReader(io.RawIOBase):
+  """Read-only file object over an iterator of byte chunks, for readers like tarfile that want a stream."""
+  def __init__(self, chunks: 'iterator', *args, **kwargs):
+    self.chunks = chunks
+    self.buffer = b""
+
+  def readable(self) -> bool:
+    return True
+
+  def readinto(self, b) -> int:
+    while not self.buffer:
+      self.buffer = next(self.chunks, None)
+      if self.buffer is None:
+        self.buffer = b""
+        return 0
+    size = min(len(b), len(self.buffer))
+    b[:size] = self.buffer[:size]
+    self.buffer = self.buffer[size:]
+    return size
+
+class Manifest(object):
+  """
+    Download records indexed by source URL and by local directory.
+
+    Backed by a journal with one JSON record per line. A later record for the same source
+    supersedes the earlier one, so nothing has to be rewritten on exit. Records are written
+    through one open handle and flushed and synced in batches, every sync_interval seconds.
+    Once superseded records pile up, the journal is compacted in the background into a fresh
+    checkpoint, which replaces it atomically.
+    Unfinished downloads are kept separately until they complete or are abandoned.
+  """
+  # Compact once the journal holds this many times as many lines as there are live records
+  compact_ratio = 2
+  compact_minimum = 10000
+
+  def __init__(self, manifest_file: str, sync_interval: float = 1.0, journal_file: str = None, *args, **kwargs):
+    self.manifest_file = manifest_file
+    # Shards read the shared manifest but journal to files of their own, merged in by the next unsharded run
+    self.journal_file = journal_file or manifest_file
+    self.sync_interval = sync_interval
+    self.by_source = {}
+    self.by_content = {}
+    self.by_size = {}
+    self.partials = {}
+    self.lock = threading.RLock()
+    # Time spent appending to and rewriting the log
+    self.write_seconds = 0.0
+    # Lines in the journal, live or superseded
+    self.lines = 0
+    self.dirty = False
+    self.compacting = None
+    self.load()
+    if self.journal_file != self.manifest_file:
+      self.load(self.journal_file)
+    else:
+      self.merge_shards()
+    self.journal = open(self.journal_file, "a")
+    self.closed = threading.Event()
+    if self.sync_interval > 0:
+      threading.Thread(target=self.sync_periodically, daemon=True).start()
+    # Whatever's still buffered shouldn't be lost just because we're exiting
+    atexit.register(self.sync)
+
+  def __len__(self) -> int:
+    return len(self.by_source)
+
+  def __iter__(self):
+    return iter(list(self.by_source.values()))
+
+  def load(self, manifest_file: str = None) -> None:
+    """Reads the log into memory, upgrading the old single-line manifest format if needed."""
+    manifest_file = manifest_file or self.manifest_file
+    if not os.path.isfile(manifest_file):
+      open(manifest_file, "w").close()
+      return
+    with open(manifest_file, "r") as f:
+      # Log records are short lines of their own, whereas the old format is one enormous line, so only look at the start
+      first = f.readline(1 << 16)
+      if first[:1] == "[" or first.rstrip("\n")[-1:] == "," or (len(first) == 1 << 16 and first[-1:] != "\n"):
+        f.seek(0)
+        self.load_legacy(f)
+        return
+      f.seek(0)
+      end = 0
+      for line in f:
+        if line[-1:] != "\n":
+          # A torn last line just means we were interrupted mid-write
+          print(f"Dropping incomplete manifest record: {line[:80]}")
+          break
+        end += len(line.encode())
+        if not line.strip():
+          continue
+        self.lines += 1
+        try:
+          self.index(DownloadFile(json.loads(line)))
+        except ValueError:
+          print(f"Skipping unreadable manifest record: {line[:80]}")
+    if end != os.path.getsize(manifest_file):
+      # Cut it off so new records don't get glued onto it
+      with open(manifest_file, "r+") as f:
+        f.truncate(end)
+
+  def merge_shards(self) -> None:
+    """Folds the journals left by sharded runs into the manifest, then removes them."""
+    shards = [x for x in os.listdir(os.path.dirname(self.manifest_file) or ".")
+      if x.startswith(f"{os.path.basename(self.manifest_file)}.shard-")]
+    if not shards:
+      return
+    for shard in sorted(shards):
+      print(f"Merging manifest from {shard}")
+      self.load(os.path.join(os.path.dirname(self.manifest_file), shard))
+    # Only once the merged manifest is safely on disk can the shards' journals go
+    self.rewrite()
+    for shard in shards:
+      os.remove(os.path.join(os.path.dirname(self.manifest_file), shard))
+
+  def load_legacy(self, f: io.TextIOBase) -> None:
+    """Reads a pre-log manifest (comma-joined JSON objects on one line) and rewrites it as a log."""
+    try:
+      for record in self.iter_legacy(f):
+        if record.get("source"):
+          self.index(DownloadFile(record))
+    except ValueError:
+      self.corrupted()
+    self.rewrite()
+
+  @staticmethod
+  def iter_legacy(f: io.TextIOBase, blocksize: int = 1 << 20):
+    """Decodes the old format's records one at a time, so it never has to be held in memory whole."""
+    decoder = json.JSONDecoder()
+    between = re.compile(r"[\s,\[\]]*")
+    buffer = ""
+    pos = 0
+    eof = False
+    while True:
+      # Skip what sits between records
+      pos = between.match(buffer, pos).end()
+      try:
+        if pos == len(buffer):
+          raise ValueError("Out of data")
+        record, pos = decoder.raw_decode(buffer, pos)
+      except ValueError:
+        # Probably just cut off at the end of the buffer
+        if eof:
+          if pos == len(buffer):
+            return
+          raise
+        block = f.read(blocksize)
+        eof = not block
+        buffer = buffer[pos:] + block
+        pos = 0
+        continue
+      yield record
+
+  def corrupted(self) -> None:
+    os.rename(self.manifest_file, f"{self.manifest_file}.corrupted")
+    raise ManifestError(f"Corrupted manifest: {self.manifest_file} (moved to {self.manifest_file}.corrupted)")
+
+  def rewrite(self) -> None:
+    """Replaces the log with one record per live entry."""
+    with self.lock:
+      started = time.perf_counter()
+      self.checkpoint(self.live(), f"{self.manifest_file}.tmp")
+      os.replace(f"{self.manifest_file}.tmp", self.manifest_file)
+      sync_dir(self.manifest_file)
+      self.lines = len(self.by_source) + len(self.partials)
+      self.write_seconds += time.perf_counter() - started
+
+  def live(self) -> list:
+    """Every record that isn't superseded."""
+    with self.lock:
+      return list(self.by_source.values()) + list(self.partials.values())
+
+  def checkpoint(self, records: list, checkpoint_file: str) -> None:
+    """Writes records to a new file and makes sure they're on disk before anything gets replaced with it."""
+    with open(checkpoint_file, "w") as f:
+      for F in records:
+        f.write(self.dump(F))
+      f.flush()
+      os.fsync(f.fileno())
+
+  def compact(self) -> None:
+    """
+      Rewrites the journal without superseded records, in the background.
+
+      The live records are written out to a checkpoint while downloads carry on. Anything journaled meanwhile
+      is then copied onto the end of the checkpoint, which replaces the journal in one rename.
+    """
+    with self.lock:
+      self.sync()
+      records = self.live()
+      mark = os.path.getsize(self.journal_file)
+    started = time.perf_counter()
+    self.checkpoint(records, f"{self.manifest_file}.tmp")
+    with self.lock:
+      self.sync()
+      with open(f"{self.manifest_file}.tmp", "ab") as f, open(self.journal_file, "rb") as journal:
+        journal.seek(mark)
+        tail = journal.read()
+        f.write(tail)
+        f.flush()
+        os.fsync(f.fileno())
+      self.journal.close()
+      os.replace(f"{self.manifest_file}.tmp", self.manifest_file)
+      sync_dir(self.manifest_file)
+      self.journal = open(self.journal_file, "a")
+      self.lines = len(records) + tail.count(b"\n")
+      self.write_seconds += time.perf_counter() - started
+
+  def compactable(self) -> bool:
+    # A shard's journal only holds part of the picture, so it's left for the merge
+    return self.journal_file == self.manifest_file and self.lines > self.compact_minimum
+
+  def sync(self) -> None:
+    """Flushes the journal and syncs it to disk."""
+    with self.lock:
+      if self.dirty and not self.journal.closed:
+        started = time.perf_counter()
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.dirty = False
+        self.write_seconds += time.perf_counter() - started
+
+  def sync_periodically(self) -> None:
+    while not self.closed.wait(self.sync_interval):
+      self.sync()
+
+  def close(self) -> None:
+    """Syncs and closes the journal, compacting it first if it's worth it. No more records can be written after this."""
+    if self.compacting:
+      self.compacting.join()
+    self.closed.set()
+    with self.lock:
+      self.sync()
+      self.journal.close()
+      atexit.unregister(self.sync)
+      if self.compactable() and self.lines > self.compact_ratio * len(self.live()):
+        self.rewrite()
+
+  def dump(self, F: 'DownloadFile') -> str:
+    return f"{json.dumps(F.to_dict())}\n"
+
+  def index(self, F: 'DownloadFile') -> None:
+    if F.partial:
+      self.partials[F.source] = F
+      return
+    # Finished (or abandoned) downloads have nothing left to resume
+    self.partials.pop(F.source, None)
+    if not F.saved:
+      return
+    old = self.by_source.get(F.source)
+    if old is not None:
+      self.by_size.get(old.dsize, {}).pop(old.source, None)
+      if self.by_content.get(old.chash) is old:
+        del self.by_content[old.chash]
+    self.by_source[F.source] = F
+    if F.chash:
+      self.by_content[F.chash] = F
+      if F.peekscheme == "sample":
+        self.by_size.setdefault(F.dsize, {})[F.source] = F
+
+  def get(self, source: str) -> 'DownloadFile':
+    """The record for a source URL, or None."""
+    return self.by_source.get(source)
+
+  def find_content(self, chash: str) -> 'DownloadFile':
+    """A record with the given content hash, or None."""
+    return self.by_content.get(chash)
+
+  def find_size(self, dsize: int) -> list:
+    """Content hashed records of the given size that have a sampled peek hash."""
+    with self.lock:
+      return list(self.by_size.get(dsize, {}).values())
+
+  def partial(self, source: str) -> 'DownloadFile':
+    """The record of an unfinished download of a source URL, or None."""
+    return self.partials.get(source)
+
+  def upsert(self, F: 'DownloadFile') -> None:
+    """Records a file, superseding any earlier record for its source."""
+    with self.lock:
+      started = time.perf_counter()
+      self.index(F)
+      self.journal.write(self.dump(F))
+      self.lines += 1
+      self.dirty = True
+      if self.sync_interval <= 0:
+        self.sync()
+      self.write_seconds += time.perf_counter() - started
+      if self.compactable() and self.lines > self.compact_ratio * (len(self.by_source) + len(self.partials)) \
+          and not (self.compacting and self.compacting.is_alive()):
+        self.compacting = threading.Thread(target=self.compact, daemon=True)
+        self.compacting.start()
+
+class ListingCache(object):
+  """
+    Validators, page digests and parsed entries of directory listings from earlier runs, keyed by branch.
+
+    It's only a cache, so it's rewritten in one go at the end of a run and thrown away if unreadable.
+  """
+  def __init__(self, cache_file: str, *args, **kwargs):
+    self.cache_file = cache_file
+    self.listings = {}
+    self.lock = threading.Lock()
+    self.dirty = False
+    try:
+      with open(self.cache_file, "r") as f:
+        for line in f:
+          listing = json.loads(line)
+          self.listings[listing.pop("branch")] = listing
+    except (OSError, ValueError, KeyError):
+      self.listings = {}
+
+  def get(self, branch: str) -> dict:
+    return self.listings.get(branch)
+
+  def put(self, branch: str, listing: dict) -> None:
+    with self.lock:
+      self.listings[branch] = listing
+      self.dirty = True
+
+  def forget(self, branch: str) -> None:
+    """Drops a listing so the next run reads its directory afresh, e.g. because some of its files didn't make it."""
+    with self.lock:
+      if self.listings.pop(branch, None) is not None:
+        self.dirty = True
+
+  def save(self) -> None:
+    with self.lock:
+      if not self.dirty:
+        return
+      with open(f"{self.cache_file}.tmp", "w") as f:
+        for branch, listing in self.listings.items():
+          f.write(f"{json.dumps(dict(listing, branch=branch))}\n")
+      os.replace(f"{self.cache_file}.tmp", self.cache_file)
+      self.dirty = False
+
+class ListingEntry(object):
+  """A link from a directory listing: where it points, the text shown for it, and any date and size columns."""
+  def __init__(self, href: str, text: str, mtime: int = 0, size: int = None, size_slack: int = 0, *args, **kwargs):
+    self.href = href
+    self.text = text
+    self.mtime = mtime # Seconds since the epoch, 0 if the listing didn't say
+    self.size = size # Bytes, None if the listing didn't say
+    self.size_slack = size_slack # How far off size may be when the listing rounds it (e.g. 1.2M)
+
+  def dump(self) -> list:
+    """The entry as a list of constructor arguments, for caching."""
+    return [self.href, self.text, self.mtime, self.size, self.size_slack]
+
+  def size_matches(self, dsize: int) -> bool:
+    """Whether a size in bytes agrees with the listing, or the listing didn't show one."""
+    return self.size is None or abs(self.size - dsize) <= self.size_slack
+
+class PathFilter(object):
+  """
+    Glob patterns (or regexes, prefixed with re:) matched against paths below the URL.
+
+    Like .gitignore, a glob without a / matches names at any depth and a glob with one matches
+    the path from the top, one segment per /, with ** standing for any number of directories.
+  """
+  def __init__(self, patterns: list, *args, **kwargs):
+    self.globs = []
+    self.regexes = []
+    for pattern in patterns:
+      if pattern.startswith("re:"):
+        self.regexes.append(re.compile(pattern[3:]))
+      elif "/" in pattern.strip("/"):
+        self.globs.append(pattern.strip("/").split("/"))
+      else:
+        self.globs.append(["**", pattern.strip("/")])
+
+  def __bool__(self) -> bool:
+    return bool(self.globs or self.regexes)
+
+  def matches(self, path: str) -> bool:
+    """Whether a path matches any of the patterns."""
+    segments = path.strip("/").split("/")
+    return any(self.match(glob, segments) for glob in self.globs) or any(x.search(path) for x in self.regexes)
+
+  def matches_within(self, path: str) -> bool:
+    """Whether a directory or any directory above it matches."""
+    segments = path.strip("/").split("/") if path.strip("/") else []
+    return any(self.matches("/".join(segments[:i])) for i in range(1, len(segments) + 1))
+
+  def may_lead_to(self, path: str) -> bool:
+    """Whether anything below a directory could match. Regexes could match anything, so they always might."""
+    segments = path.strip("/").split("/") if path.strip("/") else []
+    return bool(self.regexes) or any(self.lead(glob, segments) for glob in self.globs)
+
+  @classmethod
+  def match(cls, glob: list, segments: list) -> bool:
+    if not glob:
+      return not segments
+    if glob[0] == "**":
+      return any(cls.match(glob[1:], segments[i:]) for i in range(len(segments) + 1))
+    return bool(segments) and fnmatch.fnmatchcase(segments[0], glob[0]) and cls.match(glob[1:], segments[1:])
+
+  @classmethod
+  def lead(cls, glob: list, segments: list) -> bool:
+    # The directory's path has to match the start of the pattern, with something left over for what's below it
+    if not segments:
+      return bool(glob)
+    if not glob:
+      return False
+    if glob[0] == "**":
+      return True
+    return fnmatch.fnmatchcase(segments[0], glob[0]) and cls.lead(glob[1:], segments[1:])
+
+class ListingParser(object):
+  """
+    Pulls links out of directory listing pages.
+
+    Subclasses handle particular layouts. Add an instance to listing_parsers to make it available.
+  """
+  name = ""
+
+  def matches(self, text: str) -> bool:
+    """Whether this parser understands the page's layout."""
+    return False
+
+  def parse(self, text: str) -> list:
+    """Returns a ListingEntry for every link on the page."""
+    return []
+
+class AutoindexParser(ListingParser):
+  """Fast path for Apache, nginx, lighttpd and Python autoindex pages that never builds a document tree."""
+  name = "fast"
+  signature = re.compile(r"<(?:title|h1)>\s*(?:Index of|Directory listing for) ", re.I)
+  link = re.compile(r"<a\s[^>]*?href\s*=\s*([\"'])(.*?)\1[^>]*>(.*?)</a\s*>", re.I | re.S)
+
+  def matches(self, text: str) -> bool:
+    return bool(self.signature.search(text, 0, 4096))
+
+  # Date and size columns that follow a link, e.g. "2013-05-03 00:54  1.2G" or "03-May-2013 00:54   1234"
+  details = re.compile(
+    r"(?P<date>\d{4}-\d{2}-\d{2}|\d{2}-[A-Za-z]{3}-\d{4}|\d{4}-[A-Za-z]{3}-\d{2})\s+(?P<time>\d{2}:\d{2}(?::\d{2})?)"
+    r"(?:\s+(?P<size>\d+(?:\.(?P<decimals>\d+))?)\s*(?P<unit>[KMGTP]?)(?:i?B)?(?![\w.]))?"
+  )
+  date_formats = ["%Y-%m-%d", "%d-%b-%Y", "%Y-%b-%d"]
+  units = "KMGTP"
+
+  def parse(self, text: str) -> list:
+    entries = []
+    for match in self.link.finditer(text):
+      if not match.group(2):
+        continue
+      # Only text ahead of any markup counts, same as the first child of the link
+      entry = ListingEntry(html.unescape(match.group(2)), html.unescape(match.group(3).split("<", 1)[0]))
+      # Columns for this link run until the end of the line or the next link
+      tail_end = min(x for x in [text.find("\n", match.end()), text.find("<a", match.end()), match.end() + 512] if x >= 0)
+      self.parse_details(entry, re.sub(r"<[^>]*>", " ", text[match.end():tail_end]))
+      entries.append(entry)
+    return entries
+
+  def parse_details(self, entry: ListingEntry, tail: str) -> None:
+    """Fills in the modification time and size columns that follow a link, if there are any."""
+    details = self.details.search(html.unescape(tail))
+    if not details:
+      return
+    for date_format in self.date_formats:
+      try:
+        stamp = datetime.strptime(f"{details['date']} {details['time']}", f"{date_format} %H:%M{':%S' if details['time'].count(':') > 1 else ''}")
+      except ValueError:
+        continue
+      entry.mtime = calendar.timegm(stamp.timetuple())
+      break
+    if details["size"]:
+      multiplier = 1024 ** (self.units.index(details["unit"]) + 1) if details["unit"] else 1
+      entry.size = int(float(details["size"]) * multiplier)
+      if details["unit"]:
+        # Rounded sizes are only good to the last digit shown
+        entry.size_slack = int(multiplier / 10 ** len(details["decimals"] or ""))
+
+class SoupParser(ListingParser):
+  """Slow but thorough fallback for layouts the fast parsers don't recognize."""
+  name = "bs4"
+
+  def matches(self, text: str) -> bool:
+    return True
+
+  def parse(self, text: str) -> list:
+    from bs4 import BeautifulSoup
+    tree = BeautifulSoup(text, "html.parser")
+    entries = []
+    for node in tree.find_all("a", href=True):
+      if not node["href"]:
+        continue
+      first = node.contents[0] if node.contents else ""
+      entries.append(ListingEntry(node["href"], first if isinstance(first, str) else ""))
+    return entries
+
+# Tried in order, so keep the catch-all last
+listing_parsers = [AutoindexParser(), SoupParser()]
+
+def build_parser() -> argparse.ArgumentParser:
+  parser = argparse.ArgumentParser(
+    prog="AutoTraverse",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description=textwrap.dedent("""\
+    AutoTraverse v0.4.2a
+      by Caleb White
+       
+    Simple tool to traverse web directories and download all files contained in them.
+    
+    Options to auto-expand archives and compressed files."""),
+    epilog="""\
+Note: If you do not specify a protocol, https:// will be prepended to your URL.
+  
+Download all the things!"""
+  )
+
+  for option in default_config.keys():
+    if option[:2] == "--" and default_config[option][2] is bool:
+      parser.add_argument(
+        option,
+        help=default_config[option][0],
+        required=default_config[option][4],
+        action="store_true",
+        dest=option[2:]
+      )
+    elif option[:2] == "--":
+      parser.add_argument(
+        option,
+        help=default_config[option][0],
+        required=default_config[option][4],
+        type=default_config[option][2],
+        metavar="N" if default_config[option][2] in [int, float] else None,
+        default=None,
+        dest=option[2:]
+      )
+    elif option[:1] == "-":
+      parser.add_argument(
+        option,
+        help=default_config[option][0],
+        required=default_config[option][4],
+        # The option type is the list; argparse wants the type of its items
+        type=str if default_config[option][2] is list else default_config[option][2],
+        nargs="+",
+        dest=option[1:]
+      )
+    else:
+      parser.add_argument(
+        option,
+        help=default_config[option][0],
+        type=default_config[option][2],
+        nargs="?"
+      )
+
+  parser.add_argument(
+    "--moo",
+    help=argparse.SUPPRESS,
+    required=False,
+    action='store_true',
+    dest="moo")
+  return parser
+
+def main(argv: list = None) -> int:
+  """Runs AutoTraverse from the command line, with the config wizard and settings.yml. Returns the exit status."""
+  import yaml
+  args = build_parser().parse_args(argv)
+
+  # Moo - the most important part of all this nonsense
+  if args.moo:
+    print(textwrap.dedent("""\
+           ,=    ,        =.
+  _  _   /'/    )\\,/,/(_   \\`\\
+   `//-.|  (  ,\\\\)\\//\\)\\/_  ) |
+   //___\\   `\\\\\\/\\\\/\\/\\\\///'  /
+,-\"~`-._ `\"--'_   `\"\"\"`  _ \\`'\"~-,_
+\\       `-.  '_`.      .'_` \\ ,-\"~`/
+ `.__.-'`/   (-\\        /-) |-.__,'
+   ||   |     \\O)  /^\\ (O/  |
+   `\\\\  |         /   `\\    /
+the  \\\\  \\       /      `\\ /
+cow   `\\\\ `-.  /' .---.--.\\
+says    `\\\\/`~(, '()      ()
+'moo'    /(O) \\\\   _,.-.,_)
+        //  \\\\ `\\'`      /
+       / |  ||   `\"\"~~~\"`
+     /'  |__||
+           `o """))
+    return 0
+
+  # Load settings or use defaults
+  config = {}
+  if os.path.isfile("settings.yml"):
+    config = yaml.safe_load(open("settings.yml"))
+  if not config:
+    config = default_config.copy()
+
+  # Override default/stored values with commandline input
+  for option in default_config.keys():
+    # Strip "--" and "-" from input names to make suitable variable names
+    option_name = option[2:] if option[:2] == "--" else option
+    option_name = option_name[1:] if option_name[:1] == "-" else option_name
+    # Flags are False when left out and everything else is None, so an explicit 0 still counts
+    if getattr(args, option_name) is not None and getattr(args, option_name) is not False:
+      if not type(getattr(args, option_name)) is default_config[option][2]:
+        config[option_name] = default_config[option][2](getattr(args, option_name))
+      else:
+        config[option_name] = getattr(args, option_name)
+
+  # If config is default, offer first time wizard
+  if config == default_config:
+    print("Welcome to AutoTraverse!")
+    response = input("Would you like to go through initial configuration? [Y]es/[n]o ")
+    if response == "" or response[0] in ["y", "Y"]:
+      for option in default_config.keys():
+        option_name = option[2:] if option[:2] == "--" else option
+        option_name = option_name[1:] if option_name[:1] == "-" else option_name
+        option_value = None
+        while type(option_value) is not default_config[option][2]:
+          if default_config[option][2] == bool:
+            option_value = input(f"{default_config[option][1]} {'[Y]/[n]' if default_config[option][3] else '[y]/[N]'}: ")
+            if option_value == "":
+              option_value = default_config[option][3]
+            else:
+              option_value = True if option_value[0] in ["y", "Y"] else False
+          else:
+            option_value = input(f"{default_config[option][1]}{' (blank to skip)' if not default_config[option][4] else ''}: ")
+            if option_value == "" and not default_config[option][4]:
+              break
+            try:
+              if default_config[option][2] is list:
+                option_value = option_value.split()
+              else:
+                option_value = default_config[option][2](option_value)
+            except ValueError:
+              print("That doesn't look right. Please try again.")
+              option_value = None
+              continue
+          if option_value == "" and default_config[option][4]:
+            print("This option is required. Please try again.")
+            option_value = None
+        if option_value:
+          config[option_name] = option_value
+
+  # Handle defaults that weren't overwritten
+  for option in default_config.keys():
+    option_name = option[2:] if option[:2] == "--" else option
+    option_name = option_name[1:] if option_name[:1] == "-" else option_name
+    if option_name not in config.keys() or config[option_name] == default_config[option]:
+      config[option_name] = default_config[option][3]
+
+  # Scrub leftover defaults
+  for option in [x for x in config.keys()]:
+    if option[0] == "-":
+      del config[option]
+
+  # Final checks and input normalizing
+  try:
+    config = check_config(config)
+  except ValueError as e:
+    print(e, f"Run python {os.path.basename(__file__)} -h for details.")
+    return 1
+
+  # Write config if requested
+  if config["write-config"]:
+    with open("settings.yml", "w") as f:
+      yaml.safe_dump(config, f)
+
+  try:
+    result = Traverse(config).run()
   except KeyboardInterrupt:
     print("\nReceived keyboard interrupt. Bye!")
+    return 130
+  except ManifestError as e:
+    print(e)
+    return 1
   except:
     print("Hrmm... something went wrong.")
     raise
+  return 0 if result.ok else 1
+
+if __name__ == "__main__":
+  sys.exit(main())
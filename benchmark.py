@@ -0,0 +1,183 @@
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import tarfile
+import zipfile
+import tempfile
+import threading
+import subprocess
+import resource
+import functools
+import html
+import http.server
+
+# Benchmarks AutoTraverse end to end against a generated directory tree served locally.
+# Everything stays on this machine, so runs are reproducible and don't bother anyone's server.
+
+def get_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(
+    prog="benchmark",
+    description="Runs AutoTraverse against a generated autoindex tree on a local HTTP server.",
+    epilog="Anything after -- is passed on to AutoTraverse, e.g. -- --workers 8 --listing-parser bs4"
+  )
+  parser.add_argument("--width", type=int, default=4, help="Subdirectories per directory (default is 4).")
+  parser.add_argument("--depth", type=int, default=2, help="Levels of subdirectories below the root (default is 2).")
+  parser.add_argument("--files", type=int, default=20, help="Files per directory (default is 20).")
+  parser.add_argument("--min-size", type=int, default=1024, help="Smallest file size in bytes (default is 1024).")
+  parser.add_argument("--max-size", type=int, default=1048576, help="Largest file size in bytes (default is 1048576).")
+  parser.add_argument("--archives", type=int, default=0, help="Zip and tar.gz archives per directory (default is 0).")
+  parser.add_argument("--latency", type=float, default=0, help="Milliseconds the server waits before each response (default is 0).")
+  parser.add_argument("--listing", choices=["nginx", "python"], default="nginx", help="Listing layout, with or without date and size columns (default is nginx).")
+  parser.add_argument("--runs", type=int, default=1, help="Times to run against the same tree. Runs after the first reuse the mirror and show the cost of checking for changes (default is 1).")
+  parser.add_argument("--seed", type=int, default=1, help="Random seed for the generated tree (default is 1).")
+  parser.add_argument("--json", action="store_true", help="Print results as JSON instead of a table.")
+  argv = sys.argv[1:]
+  passthrough = []
+  if "--" in argv:
+    passthrough = argv[argv.index("--") + 1:]
+    argv = argv[:argv.index("--")]
+  args = parser.parse_args(argv)
+  args.passthrough = passthrough
+  return args
+
+def build_tree(root: str, args: argparse.Namespace) -> (int, int):
+  """Generates the directory tree to serve. Returns how many files it holds and their total size."""
+  rand = random.Random(args.seed)
+  count = total = 0
+  directories = [(root, 0)]
+  while directories:
+    directory, level = directories.pop()
+    os.makedirs(directory, exist_ok=True)
+    for i in range(args.files):
+      # Log-uniform so there's a realistic mix of small and large files
+      size = int(args.min_size * (args.max_size / args.min_size) ** rand.random()) if args.max_size > args.min_size else args.min_size
+      with open(os.path.join(directory, f"file{i:04}.bin"), "wb") as f:
+        f.write(rand.getrandbits(8 * size).to_bytes(size, "little") if size else b"")
+      count += 1
+      total += size
+    for i in range(args.archives):
+      members = {f"member{j}.txt": f"{directory} {i} {j}\n".encode() * rand.randint(1, 2000) for j in range(5)}
+      with zipfile.ZipFile(os.path.join(directory, f"archive{i:02}.zip"), "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in members.items():
+          z.writestr(name, data)
+      with tarfile.open(os.path.join(directory, f"archive{i:02}.tar.gz"), "w:gz") as t:
+        for name, data in members.items():
+          info = tarfile.TarInfo(name)
+          info.size = len(data)
+          t.addfile(info, io.BytesIO(data))
+      for name in (f"archive{i:02}.zip", f"archive{i:02}.tar.gz"):
+        count += 1
+        total += os.path.getsize(os.path.join(directory, name))
+    if level < args.depth:
+      directories += [(os.path.join(directory, f"dir{i:02}"), level + 1) for i in range(args.width)]
+  return count, total
+
+class ListingHandler(http.server.SimpleHTTPRequestHandler):
+  """Serves the tree with optional latency and nginx-style listings."""
+  latency = 0
+  listing = "nginx"
+
+  def send_head(self):
+    if self.latency:
+      time.sleep(self.latency / 1000)
+    return super().send_head()
+
+  def list_directory(self, path: str):
+    if self.listing == "python":
+      return super().list_directory(path)
+    title = html.escape(self.path)
+    lines = [f"<html>\r\n<head><title>Index of {title}</title></head>\r\n<body>\r\n<h1>Index of {title}</h1><hr><pre><a href=\"../\">../</a>\r\n"]
+    for name in sorted(os.listdir(path)):
+      full = os.path.join(path, name)
+      stat = os.stat(full)
+      is_dir = os.path.isdir(full)
+      href = f"{name}/" if is_dir else name
+      date = time.strftime("%d-%b-%Y %H:%M", time.gmtime(stat.st_mtime))
+      size = "-" if is_dir else str(stat.st_size)
+      lines.append(f"<a href=\"{href}\">{html.escape(href)}</a>{' ' * max(1, 51 - len(href))}{date} {size:>19}\r\n")
+    lines.append("</pre><hr></body>\r\n</html>\r\n")
+    encoded = "".join(lines).encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "text/html")
+    self.send_header("Content-Length", str(len(encoded)))
+    self.end_headers()
+    return io.BytesIO(encoded)
+
+  def log_message(self, *args) -> None:
+    pass
+
+def serve(root: str, args: argparse.Namespace) -> http.server.ThreadingHTTPServer:
+  handler = type("Handler", (ListingHandler,), {"latency": args.latency, "listing": args.listing})
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(handler, directory=root))
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+def run(url: str, workdir: str, args: argparse.Namespace) -> dict:
+  """Runs AutoTraverse once and returns its run report, plus wall time and peak memory."""
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AutoTraverse.py")
+  report_file = os.path.join(workdir, "report.json")
+  command = [sys.executable, script, url, os.path.join(workdir, "mirror"), "0", "--report", report_file] + args.passthrough
+  started = time.perf_counter()
+  # Run from the work directory so a settings.yml lying around here isn't picked up
+  proc = subprocess.run(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+  wall = time.perf_counter() - started
+  if proc.returncode or not os.path.isfile(report_file):
+    print(proc.stderr, file=sys.stderr)
+    sys.exit(f"AutoTraverse exited with {proc.returncode}")
+  with open(report_file) as f:
+    report = json.load(f)
+  os.remove(report_file)
+  report["wall-seconds"] = wall
+  # Runs are sequential, so the children's high-water mark only goes up. Linux reports it in KiB.
+  report["peak-rss-mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+  return report
+
+def summarize(report: dict) -> dict:
+  def seconds(*phases) -> float:
+    return sum(report["phases"].get(x, {}).get("seconds", 0.0) for x in phases)
+  elapsed = report["elapsed"] or 1e-9
+  return {
+    "files": int(report["summary"]["files-downloaded"]),
+    "files/s": report["summary"]["files-downloaded"] / elapsed,
+    "MB/s": report["summary"]["bytes-downloaded"] / elapsed / 1e6,
+    "elapsed s": report["elapsed"],
+    "wall s": report["wall-seconds"],
+    "listing parse s": seconds("listing-parse"),
+    "manifest load s": seconds("manifest-load"),
+    "manifest save s": seconds("manifest-write", "listing-cache-save"),
+    "peak RSS MB": report["peak-rss-mb"],
+  }
+
+def main() -> None:
+  args = get_args()
+  workdir = tempfile.mkdtemp(prefix="autotraverse-bench-")
+  try:
+    root = os.path.join(workdir, "site")
+    started = time.perf_counter()
+    count, total = build_tree(root, args)
+    if not args.json:
+      print(f"Generated {count} files ({total / 1e6:.1f} MB) in {time.perf_counter() - started:.1f}s")
+    server = serve(root, args)
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    results = []
+    for i in range(args.runs):
+      results.append(summarize(run(url, workdir, args)))
+    server.shutdown()
+    if args.json:
+      print(json.dumps(results, indent=2))
+      return
+    columns = list(results[0])
+    print(" ".join(f"{x:>15}" for x in ["run"] + columns))
+    for i, result in enumerate(results, 1):
+      print(" ".join(f"{x:>15}" if isinstance(x, int) else f"{x:>15.3f}" for x in [i] + list(result.values())))
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+  main()